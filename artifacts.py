@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Content-addressed store for finished bundle outputs, shared between
+# checkouts and deploys. It's enabled by pointing settings.BUNDLES_ARTIFACT_CACHE
+# to a directory and is bounded to BUNDLES_ARTIFACT_CACHE_SIZE bytes, evicting
+# the least recently used entries first.
+#
+# Entries are linked into the bundles directory when possible, so bundle
+# files must always be replaced by renaming and never rewritten in place.
+
+import os
+import shutil
+import hashlib
+
+from django.conf import settings
+
+DEFAULT_SIZE = 256 * 1024 * 1024
+
+def make_key(*parts):
+    m = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        m.update(str(part))
+        m.update('\0')
+
+    return m.hexdigest()
+
+class ArtifactStore(object):
+    def __init__(self, root, max_size=DEFAULT_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, key):
+        return os.path.join(self.root, key[:2], key[2:])
+
+    def fetch(self, key, dest):
+        path = self.get_path(key)
+        tmp_path = '%s.%d.tmp' % (dest, os.getpid())
+        try:
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copyfile(path, tmp_path)
+        except (IOError, OSError):
+            self.misses += 1
+            return False
+
+        os.rename(tmp_path, dest)
+        # The mtime of an entry records when it was last used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return True
+
+    def put(self, key, src):
+        path = self.get_path(key)
+        if os.path.exists(path):
+            return
+        entry_dir = os.path.dirname(path)
+        if not os.path.isdir(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                # Created by another process
+                pass
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        shutil.copyfile(src, tmp_path)
+        os.rename(tmp_path, path)
+
+    def entries(self):
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for prefix in os.listdir(self.root):
+            entry_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(entry_dir):
+                continue
+            for name in os.listdir(entry_dir):
+                path = os.path.join(entry_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+        return entries
+
+    def stats(self):
+        entries = self.entries()
+        return len(entries), sum([size for mtime, size, path in entries])
+
+    def prune(self, max_size=None):
+        if max_size is None:
+            max_size = self.max_size
+        entries = self.entries()
+        entries.sort()
+        total = sum([size for mtime, size, path in entries])
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+
+        return removed, total
+
+_STORE = None
+
+def get_artifact_store():
+    global _STORE
+    if _STORE is None:
+        root = getattr(settings, 'BUNDLES_ARTIFACT_CACHE', None)
+        if not root:
+            return None
+        _STORE = ArtifactStore(root,
+            getattr(settings, 'BUNDLES_ARTIFACT_CACHE_SIZE', DEFAULT_SIZE))
+
+    return _STORE
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Benchmarks for the hot paths of this app. A synthetic media tree and
+# bundles.yaml are generated in a temporary directory and Django is
+# configured in-process, so no project nor network access is needed.
+# Results are printed (or written with -o) as JSON, to compare runs.
+
+import os
+from os.path import dirname, abspath
+import sys
+import time
+import random
+import shutil
+import tempfile
+import platform
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+# Imported from bundles once Django is configured
+compressors = None
+
+def make_compressor_class():
+    # Stands in for YUI Compressor, so only this app's overhead is measured
+    class StubCompressor(compressors.Compressor):
+        name = 'stub'
+        version = '1'
+
+        def compress(self, data, file_type, verbose=False):
+            return data.replace('\n\n', '\n')
+
+    return StubCompressor
+
+def write_file(path, data):
+    if not os.path.isdir(dirname(path)):
+        os.makedirs(dirname(path))
+    fp = open(path, 'w')
+    fp.write(data)
+    fp.close()
+
+def filler(size, rnd):
+    words = ['var', 'function', 'return', 'color', 'margin', 'padding', 'x', 'y']
+    parts = []
+    length = 0
+    while length < size:
+        word = rnd.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+    text = ' '.join(parts)
+    lines = []
+    for ii in range(0, len(text), 72):
+        lines.append(text[ii:ii + 72])
+    return '\n'.join(lines)[:size] + '\n'
+
+def generate_tree(root, options):
+    rnd = random.Random(options.seed)
+    media = os.path.join(root, 'media')
+    conf = []
+    images = []
+    for ii in range(options.images):
+        name = 'img/i%d.png' % ii
+        write_file(os.path.join(media, name), os.urandom(256))
+        conf.append('%s:\n' % name)
+        images.append(name)
+
+    for ii in range(options.bundles):
+        ext = ii % 2 and 'css' or 'js'
+        files = []
+        for jj in range(options.files):
+            name = '%s/b%d/f%d.%s' % (ext, ii, jj, ext)
+            lines = [filler(options.size, rnd)]
+            for kk in range(options.references):
+                if not images:
+                    break
+                image = rnd.choice(images)
+                if ext == 'css':
+                    lines.append('.c%d { background: url(../%s); }\n' % (kk, image))
+                else:
+                    lines.append('var img%d = "%s";\n' % (kk, image))
+            write_file(os.path.join(media, name), ''.join(lines))
+            files.append(name)
+        conf.append('b%d.%s:\n    files:\n' % (ii, ext))
+        for name in files:
+            conf.append('        - %s\n' % name)
+
+    write_file(os.path.join(root, 'bundles.yaml'), ''.join(conf))
+    return media
+
+def configure(root, media):
+    # The app is imported as "bundles", whatever its directory is called
+    os.symlink(dirname(abspath(__file__)), os.path.join(root, 'bundles'))
+    sys.path.insert(0, root)
+    from django.conf import settings
+    settings.configure(
+        DEBUG=False,
+        TEMPLATE_DEBUG=False,
+        MEDIA_ROOT=media + '/',
+        MEDIA_URL='/media/',
+        BUNDLES_URL='/media/bundles/',
+        SITE_NAME='example.com',
+        INSTALLED_APPS=('bundles', ),
+        BUNDLES_DIR=root,
+        BUNDLES_MANIFEST=False,
+        BUNDLES_COMPRESSOR='bundles.bench.StubCompressor',
+    )
+    global compressors, StubCompressor
+    from bundles import compressors
+    StubCompressor = make_compressor_class()
+    sys.modules['bundles.bench'] = sys.modules[__name__]
+
+def clean(media):
+    shutil.rmtree(os.path.join(media, 'bundles'), True)
+
+def timed(func, repeat):
+    # Returns the best time of repeat runs
+    best = None
+    for ii in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def run(root, options):
+    media = generate_tree(root, options)
+    configure(root, media)
+    from bundles import libbundler, builder, hashcache
+    from bundles.manager import BundleManager
+    results = {}
+
+    def cold_start():
+        clean(media)
+        hashcache._CACHE = None
+        cache_path = os.path.join(root, hashcache.CACHE_NAME)
+        if os.path.exists(cache_path):
+            os.unlink(cache_path)
+        BundleManager(root).ensure_built()
+    results['manager_cold'] = timed(cold_start, options.repeat)
+
+    def warm_start():
+        hashcache._CACHE = None
+        BundleManager(root).ensure_built()
+    results['manager_warm'] = timed(warm_start, options.repeat)
+
+    bundles = libbundler.get_bundles(root)
+
+    def build():
+        clean(media)
+        builder.build_bundles(bundles, jobs=options.jobs)
+    results['build'] = timed(build, options.repeat)
+
+    def concatenate():
+        clean(media)
+        for bundle in bundles.values():
+            bundle.build()
+    rereference_times = []
+    for ii in range(options.repeat):
+        concatenate()
+        start = time.time()
+        libbundler.rereference_bundles(bundles)
+        rereference_times.append(time.time() - start)
+    results['rereference'] = min(rereference_times)
+
+    def compress():
+        for bundle in bundles.values():
+            bundle.compress()
+    results['compress'] = timed(compress, options.repeat)
+
+    from django.template import Template, Context
+    names = sorted(bundles)[:options.tag_bundles]
+    manager = BundleManager.manager()
+    manager.ensure_built()
+    context = Context()
+    single = Template('{%% load bundler %%}{%% bundle "%s" %%}' % names[0])
+    several = Template('{%% load bundler %%}{%% bundles %s %%}' % \
+        ' '.join(['"%s"' % name for name in names]))
+    context['names'] = names
+    dynamic = Template('{% load bundler %}{% for name in names %}{% bundles name %}{% endfor %}')
+    for key, tmpl in (('bundle_tag', single), ('bundles_tag', several),
+        ('bundles_tag_dynamic', dynamic)):
+        elapsed = timed(lambda: [tmpl.render(context) for ii in xrange(options.renders)],
+            options.repeat)
+        results[key] = elapsed
+        results[key + '_per_second'] = options.renders / elapsed
+
+    return results
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options]')
+    parser.add_option('-n', '--bundles', type='int', dest='bundles', default=100,
+        help='Number of JS and CSS bundles (defaults to 100)')
+    parser.add_option('-f', '--files', type='int', dest='files', default=5,
+        help='Files per bundle (defaults to 5)')
+    parser.add_option('-s', '--size', type='int', dest='size', default=8192,
+        help='Size of each file in bytes (defaults to 8192)')
+    parser.add_option('-i', '--images', type='int', dest='images', default=50,
+        help='Number of image bundles (defaults to 50)')
+    parser.add_option('-r', '--references', type='int', dest='references', default=5,
+        help='References to image bundles in each file (defaults to 5)')
+    parser.add_option('-J', '--jobs', type='int', dest='jobs', default=1,
+        help='Processes used by the build benchmark (defaults to 1)')
+    parser.add_option('-t', '--tag-bundles', type='int', dest='tag_bundles', default=5,
+        help='Bundles included by the {% bundles %} benchmark (defaults to 5)')
+    parser.add_option('-R', '--renders', type='int', dest='renders', default=10000,
+        help='Renders per tag benchmark (defaults to 10000)')
+    parser.add_option('--repeat', type='int', dest='repeat', default=3,
+        help='Runs of each benchmark, the best one is reported (defaults to 3)')
+    parser.add_option('--seed', type='int', dest='seed', default=0,
+        help='Seed for the generated sources (defaults to 0)')
+    parser.add_option('-o', '--output', type='string', dest='output', default=None,
+        help='Write the results to this file instead of stdout')
+    parser.add_option('-k', '--keep', action='store_true', dest='keep', default=False,
+        help='Keep the generated tree')
+    (options, args) = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bundles-bench-')
+    try:
+        results = run(root, options)
+    finally:
+        if options.keep:
+            print >> sys.stderr, 'Generated tree kept in %s' % root
+        else:
+            shutil.rmtree(root, True)
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'parameters': dict((key, getattr(options, key)) for key in ('bundles',
+            'files', 'size', 'images', 'references', 'jobs', 'tag_bundles',
+            'renders', 'repeat', 'seed')),
+        'results': results,
+    }
+    data = json.dumps(report, indent=4, sort_keys=True)
+    if options.output:
+        fp = open(options.output, 'w')
+        fp.write(data + '\n')
+        fp.close()
+    else:
+        print data
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Every bundle goes through build -> rereference -> compress, the first two
+# in a single pass when possible. rereference() only needs the final names
+# of the other bundles, which are derived from their sources and the names
+# of the bundles they reference when the bundles are created, so once
+# get_bundles() returns each bundle can run through its pipeline
+# independently of the others.
+
+import os
+
+from django.conf import settings
+
+from bundles.libbundler import link_bundles
+from bundles import stats
+
+_BUNDLES = None
+
+def get_jobs():
+    return getattr(settings, 'BUNDLES_BUILD_JOBS', 1)
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def process_bundle(bundle, bundles, compress=False, verbose=False,
+    rebuilt_only=False, force=False):
+    # Every phase is recorded in bundles.stats, with the size of the
+    # bundle before and after it
+    path = bundle.get_bundle_path()
+    timer = stats.Timer(bundle.name, 'build')
+    built = bundle.build(force=force, other_bundles=bundles)
+    size = _size(path)
+    if built:
+        timer.stop(sum([_size(bundle.get_source_name(f)) for f in bundle.files]), size)
+    if rebuilt_only and not built:
+        return False
+
+    # References are rewritten while building, unless the bundle
+    # already existed or was fetched from the artifact store
+    if not bundle.rewritten:
+        timer = stats.Timer(bundle.name, 'rereference')
+        bundle.rereference(bundles)
+        timer.stop(size, _size(path))
+        size = _size(path)
+    if compress:
+        timer = stats.Timer(bundle.name, 'compress')
+        bundle.compress(verbose)
+        timer.stop(size, _size(path))
+        size = _size(path)
+    # Written once the contents are final
+    timer = stats.Timer(bundle.name, 'gzip')
+    if bundle.write_gzip():
+        timer.stop(size, _size(bundle.get_gzip_path()))
+    bundle.set_integrity(bundle.compute_integrity())
+
+    return built
+
+class ReferenceGraph(object):
+    # Which bundles reference which, used to find the bundles that need
+    # their references rewritten when another bundle gets a new name
+    def __init__(self, bundles, names=None):
+        self.references = {}
+        self.dependents = {}
+        if names is None:
+            names = bundles.keys()
+        for name in names:
+            self.update(name, bundles[name].get_references(bundles))
+
+    def update(self, name, references):
+        for ref in self.references.get(name, ()):
+            self.dependents[ref].discard(name)
+        self.references[name] = set(references)
+        for ref in references:
+            self.dependents.setdefault(ref, set()).add(name)
+
+    def get_dependents(self, name):
+        return self.dependents.get(name, set())
+
+    def get_references(self, name):
+        return self.references.get(name, set())
+
+def rebuild_bundles(bundles, names, graph, compress=False, verbose=False):
+    # Rebuilds the named bundles, whose sources changed, and every bundle
+    # referencing a bundle which got a new name, which gets a new name too.
+    # Returns the rebuilt names. Rebuilt bundles are replaced in bundles
+    # by copies, the original objects are left untouched.
+    def refresh(name):
+        bundle = bundles[name] = bundles[name].clone()
+        return bundle.refresh()
+
+    renamed = set([name for name in names if refresh(name)])
+    for name in names:
+        graph.update(name, bundles[name].get_references(bundles))
+    renamed.update(link_bundles(bundles, graph.references.keys(),
+        graph.get_references, copy=True))
+    affected = set(names) | renamed
+    for name in renamed:
+        affected.update(graph.get_dependents(name))
+
+    for name in sorted(affected):
+        bundle = bundles[name]
+        process_bundle(bundle, bundles, compress, verbose, force=True)
+        graph.update(name, bundle.get_references(bundles))
+
+    return sorted(affected)
+
+def _init_worker(bundles):
+    global _BUNDLES
+    _BUNDLES = bundles
+    stats.set_signals(False)
+
+def _process_bundle(args):
+    # The records and the integrity are sent back to the parent
+    name, compress, verbose, rebuilt_only = args
+    collector = stats.collect()
+    try:
+        built = process_bundle(_BUNDLES[name], _BUNDLES, compress,
+            verbose, rebuilt_only)
+    finally:
+        stats.stop(collector)
+    return name, built, collector.records, _BUNDLES[name].integrity
+
+def build_bundles(bundles, jobs=1, compress=False, verbose=False,
+    rebuilt_only=False, callback=None):
+    # Returns the names of the bundles which had to be built. The callback,
+    # if any, is called in this process with the name of each finished bundle
+    names = sorted(bundles)
+    if jobs > 1 and len(names) > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(jobs, len(names)), _init_worker, (bundles, ))
+        try:
+            tasks = [(name, compress, verbose, rebuilt_only) for name in names]
+            results = pool.imap_unordered(_process_bundle, tasks)
+            return _collect(_replay(results, bundles), callback)
+        finally:
+            pool.close()
+            pool.join()
+
+    return _collect(((name, process_bundle(bundles[name], bundles, compress,
+        verbose, rebuilt_only)) for name in names), callback)
+
+def _replay(results, bundles):
+    for name, built, records, integrity in results:
+        stats.replay(records)
+        if integrity is not None:
+            bundles[name].set_integrity(integrity)
+        yield name, built
+
+def _collect(results, callback):
+    rebuilt = []
+    for name, built in results:
+        if built:
+            rebuilt.append(name)
+        if callback:
+            callback(name)
+
+    return rebuilt
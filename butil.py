@@ -1,5 +1,4 @@
 #!/usr/bin/python
-
 # -*- coding: utf-8 -*-
 
 # Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
@@ -29,21 +28,75 @@ import sys
 from optparse import OptionParser
 
 def build_bundles(bundles, options):
-    from bundles import libbundler
-    for name, bundle in bundles.iteritems():
-        print 'Bulding bundle "%s"' % name
-        bundle.build()
-
-    libbundler.rereference_bundles(bundles)
-
-    if options.compress:
-        for name, bundle in bundles.iteritems():
-            print 'Compressing bundle "%s"' % name
-            bundle.compress(options.verbose)
+    from bundles import libbundler, builder, artifacts
+    from bundles.locking import get_build_lock
+
+    def built(name):
+        if options.compress:
+            print 'Built and compressed bundle "%s"' % name
+        else:
+            print 'Built bundle "%s"' % name
+
+    # Wait for any running server process to finish its own build
+    lock = get_build_lock(options.dir)
+    lock.acquire()
+    try:
+        builder.build_bundles(bundles, jobs=options.jobs, compress=options.compress,
+            verbose=options.verbose, callback=built)
+
+        # A manifest describing only some of the bundles would hide the rest
+        if not options.bundles:
+            print 'Writing manifest'
+            libbundler.write_manifest(options.dir, bundles)
+    finally:
+        lock.release()
+
+    store = artifacts.get_artifact_store()
+    if store is not None:
+        store.prune()
+
+def write_stats(collector, options):
+    from bundles import stats
+    stats.stop(collector)
+    if options.stats:
+        print collector.table()
+    if options.stats_file:
+        try:
+            import json
+        except ImportError:
+            from django.utils import simplejson as json
+        fp = open(options.stats_file, 'w')
+        fp.write(json.dumps(collector.report(), indent=4, sort_keys=True) + '\n')
+        fp.close()
+        print 'Wrote build stats to %s' % options.stats_file
+
+def open_artifact_store():
+    from bundles import artifacts
+    store = artifacts.get_artifact_store()
+    if store is None:
+        print 'The artifact cache is disabled (set BUNDLES_ARTIFACT_CACHE to enable it)'
+    return store
+
+def cache_stats(options):
+    store = open_artifact_store()
+    if store is not None:
+        count, size = store.stats()
+        print 'Artifact cache at %s' % store.root
+        print '\t%d entries, %d bytes (limit %d bytes)' % (count, size, store.max_size)
+
+def cache_prune(options):
+    store = open_artifact_store()
+    if store is not None:
+        removed, size = store.prune()
+        print 'Removed %d entries, %d bytes left' % (removed, size)
 
 def get_bundles(options):
     from bundles import libbundler
+    from bundles.hashcache import get_hash_cache
     bundles = libbundler.get_bundles(options.dir)
+    cache = get_hash_cache()
+    if options.verbose and cache is not None:
+        print cache.stats()
     if not options.bundles:
         return bundles
 
@@ -60,6 +113,45 @@ def print_bundles(bundles, options):
         for f in v.files:
             print '\t%s' % f
 
+def print_inlined(bundles, options):
+    from bundles.stats import format_size
+    for name in sorted(bundles):
+        bundle = bundles[name]
+        if not getattr(bundle, 'inline_max_bytes', 0):
+            continue
+        inlined = bundle.get_inlined()
+        print 'Bundle: %s (%d images inlined, up to %s)' % (name, len(inlined),
+            format_size(bundle.inline_max_bytes))
+        for path, size in inlined:
+            print '\t%s (%s)' % (path, format_size(size))
+
+def merge_usage(options):
+    from bundles.libbundler import load_bundles_conf, MERGED_CONF_NAME
+    from bundles.usage import load_usage
+    from bundles.merging import analyze, get_merged_name, write_merged_conf
+
+    path = options.merge_usage or options.analyze_usage
+    try:
+        pages = load_usage(path)
+    except (IOError, OSError), e:
+        print 'Cannot read usage from %s: %s' % (path, e)
+        sys.exit(1)
+
+    raw_bundles = load_bundles_conf(options.dir)
+    proposals = analyze(pages, raw_bundles, options.merge_min_share,
+        options.merge_min_count)
+    print '%d pages recorded, %d merged bundles proposed' % \
+        (sum(pages.values()), len(proposals))
+    for members, count in proposals:
+        print 'Bundle: %s (requested together by %d pages)' % \
+            (get_merged_name(members, raw_bundles), count)
+        for name in members:
+            print '\t%s' % name
+
+    if options.merge_usage:
+        write_merged_conf(options.dir, proposals, raw_bundles)
+        print 'Written to %s' % os.path.join(options.dir, MERGED_CONF_NAME)
+
 def download_file(url, destdir, verbose=True):
     from urllib2 import urlopen
     from cStringIO import StringIO
@@ -123,28 +215,65 @@ def install_deps(destdir):
     print 'Installing jslint'
     download_file(JSLINT_URL, destdir)
 
-def jslint_file(file_name):
+def jslint(bundles, files, options):
+    # Returns the exit status: 1 if any issue is found, 2 if files
+    # can't be linted
     from django.conf import settings
-    from libbundler import RHINO_JAR, JSLINT
-    this_dir = os.path.dirname(os.path.abspath(__file__))
-    rhino_jar = os.path.join(this_dir, RHINO_JAR)
-    if not os.path.exists(rhino_jar):
-        print 'Cannot find "%s"' % rhino_jar
-        return
-    jslint = os.path.join(this_dir, JSLINT)
-    if not os.path.exists(jslint):
-        print 'Cannot find "%s"' % jslint
-        return
-
-    print 'JSLinting %s' % file_name
-    os.system('java -jar %s %s %s' %
-        (rhino_jar, jslint, os.path.join(settings.MEDIA_ROOT, file_name)))
-
-def jslint(bundles, options):
+    from bundles.libbundler import LintError
+    from bundles.jslint import JSLint, get_lint_cache
+    try:
+        import json
+    except ImportError:
+        from django.utils import simplejson as json
+
+    linter = JSLint()
+    missing = linter.missing()
+    if missing:
+        print missing
+        return 2
+
+    names = []
     for bundle in bundles.values():
         if bundle.file_type == 'js':
-            for fname in bundle.files:
-                jslint_file(fname)
+            names.extend(bundle.files)
+    names.extend(files)
+    paths = []
+    for name in names:
+        path = os.path.join(settings.MEDIA_ROOT, name)
+        if path not in paths:
+            paths.append(path)
+
+    cache = get_lint_cache(options.dir, linter.jslint)
+    try:
+        results, cached = linter.lint(paths, options.jobs, cache)
+    except LintError, e:
+        print e
+        return 2
+    if cache is not None:
+        try:
+            cache.save()
+        except (IOError, OSError):
+            pass
+
+    issues = sum([len(errors) for path, errors in results])
+    if options.jslint_json:
+        print json.dumps({
+            'files': [{'file': path, 'errors': errors} for path, errors in results],
+            'issues': issues,
+            'cached': cached,
+        }, indent=4)
+    else:
+        for path, errors in results:
+            for error in errors:
+                line = u'%s:%d:%d: %s' % (path, error['line'], error['character'],
+                    error['reason'])
+                if error['evidence'] and options.verbose:
+                    line += u'\n\t%s' % error['evidence'].strip()
+                print line.encode('utf-8')
+        print '%d issues in %d files (%d unchanged since linted)' % \
+            (issues, len(results), cached)
+
+    return issues and 1 or 0
 
 def main():
     proj_dir = dirname(dirname(abspath(sys.argv[0])))
@@ -165,10 +294,32 @@ def main():
         help='Directory where bundles.yaml is located (defaults to %s)' % proj_dir)
     parser.add_option('-l', '--list', action='store_true', dest='list_bundles', default=False,
         help='List bundles')
+    parser.add_option('--inlined', action='store_true', dest='inlined', default=False,
+        help='List the images inlined in CSS bundles with inline_max_bytes')
     parser.add_option('-i', '--install', action='store_true', dest='install', default=False,
         help='Install YUI Compressor, Rhino and JSLint (Java is required for them)')
     parser.add_option('-j', '--jslint', action='store_true', dest='jslint', default=False,
         help='JSLint files or bundles passed in the command line (requires Rhino, JSLint and Java)')
+    parser.add_option('--jslint-json', action='store_true', dest='jslint_json', default=False,
+        help='With --jslint, print the issues found as JSON')
+    parser.add_option('-J', '--jobs', action='store', type='int', dest='jobs', default=1,
+        help='Number of processes used to build, compress and lint bundles (defaults to 1)')
+    parser.add_option('--cache-stats', action='store_true', dest='cache_stats', default=False,
+        help='Show the size of the artifact cache')
+    parser.add_option('--cache-prune', action='store_true', dest='cache_prune', default=False,
+        help='Evict the least recently used entries from the artifact cache')
+    parser.add_option('--stats', action='store_true', dest='stats', default=False,
+        help='When building bundles, show the time spent in every phase')
+    parser.add_option('--stats-file', action='store', type='string', dest='stats_file', default=None,
+        help='When building bundles, write the time spent in every phase to this file as JSON')
+    parser.add_option('--analyze-usage', action='store', type='string', dest='analyze_usage', default=None,
+        help='Propose merging the bundles used together according to this usage file')
+    parser.add_option('--merge-usage', action='store', type='string', dest='merge_usage', default=None,
+        help='Like --analyze-usage, but also write the proposed bundles to bundles.merged.yaml')
+    parser.add_option('--merge-min-share', action='store', type='float', dest='merge_min_share', default=0.9,
+        help='Merge bundles requested together by at least this share of the pages using each of them (defaults to 0.9)')
+    parser.add_option('--merge-min-count', action='store', type='int', dest='merge_min_count', default=10,
+        help='Merge bundles requested together by at least this many pages (defaults to 10)')
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose', default=False,
         help='Prints more information while compressing files')
 
@@ -182,6 +333,13 @@ def main():
         install_deps(dirname(abspath(sys.argv[0])))
         sys.exit(0)
 
+    if options.cache_stats or options.cache_prune:
+        if options.cache_prune:
+            cache_prune(options)
+        if options.cache_stats:
+            cache_stats(options)
+        sys.exit(0)
+
     options.bundles = []
     for name in args[1:]:
         options.bundles.append(name)
@@ -189,21 +347,34 @@ def main():
     if not options.dir:
         options.dir = proj_dir
 
+    if options.analyze_usage or options.merge_usage:
+        merge_usage(options)
+        sys.exit(0)
+
+    # Started before the bundles are created, so hashing is included
+    collector = None
+    if options.build and (options.stats or options.stats_file):
+        from bundles import stats
+        collector = stats.collect()
+
     bundles = get_bundles(options)
 
     if options.list_bundles:
         print_bundles(bundles, options)
         sys.exit(0)
 
-    if options.jslint:
-        jslint(bundles, options)
-        for arg in args[1:]:
-            if arg not in bundles:
-                jslint_file(arg)
+    if options.inlined:
+        print_inlined(bundles, options)
         sys.exit(0)
 
+    if options.jslint:
+        files = [arg for arg in args[1:] if arg not in bundles]
+        sys.exit(jslint(bundles, files, options))
+
     if options.build:
         build_bundles(bundles, options)
+        if collector is not None:
+            write_stats(collector, options)
         sys.exit(0)
 
     print 'Tell me something to do!'
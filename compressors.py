@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Compressor backends. The one used by YUIBundle.compress() is chosen with
+# settings.BUNDLES_COMPRESSOR (a dotted path to a Compressor subclass, by
+# default YUICompressor). If settings.BUNDLES_COMPRESSOR_WORKER is set to a
+# command, a pool of BUNDLES_COMPRESSOR_WORKERS resident processes running
+# that command is used instead. Resident workers speak a simple protocol over
+# their stdin and stdout:
+#
+#   request:  "<file type> <length>\n<data>"
+#   response: "OK <length>\n<compressed data>" or "ERR <length>\n<message>"
+#
+# Running this module with a dotted path to a Compressor subclass serves
+# that compressor over the same protocol.
+#
+# YUICompressor keeps its own pool of resident workers running
+# yuicompressor_worker.js with Rhino, when Java and Rhino are available
+# (see butil.py --install), unless settings.BUNDLES_COMPRESSOR_RESIDENT is
+# False. Otherwise a JVM is started for every bundle.
+
+import os
+import sys
+import subprocess
+from threading import Condition
+from distutils.spawn import find_executable
+
+from django.conf import settings
+
+from bundles.libbundler import CompressionError, YUIC_JAR, YUIC_VERSION, RHINO_JAR
+
+YUIC_WORKER = 'yuicompressor_worker.js'
+
+class WorkerError(CompressionError):
+    # The worker process failed, rather than the data it was given
+    pass
+
+class Compressor(object):
+    name = None
+    version = None
+    # Anything else affecting the output, used to key cached results
+    options = ''
+
+    def missing(self):
+        # Returns a message explaining why this compressor can't be used
+        return None
+
+    def compress(self, data, file_type, verbose=False):
+        # Returns data compressed, raising CompressionError when it can't
+        # be. Every subclass must implement it.
+        raise NotImplementedError('%s does not implement compress()' % \
+            self.__class__.__name__)
+
+    def __str__(self):
+        return '%s %s' % (self.name, self.version)
+
+class YUICompressor(Compressor):
+    name = 'yuicompressor'
+    version = YUIC_VERSION
+
+    def __init__(self, jar=None, rhino_jar=None, resident=None):
+        this_dir = os.path.dirname(os.path.abspath(__file__))
+        self.jar = jar or os.path.join(this_dir, YUIC_JAR)
+        self.rhino_jar = rhino_jar or os.path.join(this_dir, RHINO_JAR)
+        self.worker = os.path.join(this_dir, YUIC_WORKER)
+        if resident is None:
+            resident = getattr(settings, 'BUNDLES_COMPRESSOR_RESIDENT', True)
+        self.workers = None
+        if resident and self.can_reside():
+            self.workers = WorkerCompressor(self.get_worker_command(),
+                getattr(settings, 'BUNDLES_COMPRESSOR_WORKERS', 2), str(self))
+
+    def missing(self):
+        if not os.path.exists(self.jar):
+            return 'Cannot find "%s"' % self.jar
+        return None
+
+    def can_reside(self):
+        for path in (self.jar, self.rhino_jar, self.worker):
+            if not os.path.exists(path):
+                return False
+        return find_executable('java') is not None
+
+    def get_worker_command(self):
+        # YUI Compressor goes first, its Rhino classes are patched
+        return ['java', '-cp', os.pathsep.join([self.jar, self.rhino_jar]),
+            'org.mozilla.javascript.tools.shell.Main', self.worker]
+
+    def compress(self, data, file_type, verbose=False):
+        # Workers don't report warnings, so verbose runs start a JVM
+        if self.workers is not None and not verbose:
+            try:
+                return self.workers.compress(data, file_type)
+            except WorkerError, e:
+                print '%s, starting a JVM for every bundle' % e
+                self.workers = None
+        return self.spawn(data, file_type, verbose)
+
+    def spawn(self, data, file_type, verbose=False):
+        command = ['java', '-jar', self.jar, '--type', file_type]
+        if verbose:
+            command.append('-v')
+        try:
+            p = subprocess.Popen(command, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError, e:
+            raise CompressionError('Cannot run java: %s' % e)
+        out, err = p.communicate(data)
+        if verbose and err:
+            print err
+        if p.returncode != 0:
+            raise CompressionError('%s failed with status %d: %s' % \
+                (self.name, p.returncode, err.strip()))
+        return out
+
+class CompressorProcess(object):
+    def __init__(self, command):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, close_fds=True)
+
+    def request(self, file_type, data):
+        self.process.stdin.write('%s %d\n' % (file_type, len(data)))
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+        if not header:
+            raise IOError('worker exited with status %s' % self.process.poll())
+        status, length = header.split()
+        return status, self.process.stdout.read(int(length))
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait()
+        except (IOError, OSError):
+            pass
+
+class WorkerCompressor(Compressor):
+    name = 'worker'
+
+    def __init__(self, command, size=2, version=None):
+        self.command = command
+        self.size = size
+        self.version = version or ' '.join(command)
+        self.cond = Condition()
+        self.reset()
+
+    def reset(self):
+        # Workers are never shared with forked children
+        self.pid = os.getpid()
+        self.idle = []
+        self.count = 0
+
+    def acquire(self):
+        self.cond.acquire()
+        try:
+            if self.pid != os.getpid():
+                self.reset()
+            while not self.idle and self.count >= self.size:
+                self.cond.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.count += 1
+        finally:
+            self.cond.release()
+
+        try:
+            return CompressorProcess(self.command)
+        except OSError, e:
+            self.release(None, True)
+            raise WorkerError('Cannot start compressor worker "%s": %s' % \
+                (self.version, e))
+
+    def release(self, worker, broken=False):
+        self.cond.acquire()
+        try:
+            if broken:
+                self.count -= 1
+                if worker is not None:
+                    worker.close()
+            else:
+                self.idle.append(worker)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def compress(self, data, file_type, verbose=False):
+        worker = self.acquire()
+        try:
+            status, payload = worker.request(file_type, data)
+        except (IOError, OSError, ValueError), e:
+            self.release(worker, True)
+            raise WorkerError('Compressor worker "%s" failed: %s' % \
+                (self.version, e))
+        self.release(worker)
+        if status != 'OK':
+            raise CompressionError(payload)
+        return payload
+
+    def close(self):
+        self.cond.acquire()
+        try:
+            for worker in self.idle:
+                worker.close()
+            self.count -= len(self.idle)
+            self.idle = []
+        finally:
+            self.cond.release()
+
+def load_class(path):
+    module, attr = path.rsplit('.', 1)
+    return getattr(__import__(module, {}, {}, [attr]), attr)
+
+_COMPRESSOR = None
+
+def get_compressor():
+    global _COMPRESSOR
+    if _COMPRESSOR is None:
+        command = getattr(settings, 'BUNDLES_COMPRESSOR_WORKER', None)
+        if command:
+            if isinstance(command, basestring):
+                command = command.split()
+            _COMPRESSOR = WorkerCompressor(command,
+                getattr(settings, 'BUNDLES_COMPRESSOR_WORKERS', 2))
+        else:
+            path = getattr(settings, 'BUNDLES_COMPRESSOR',
+                'bundles.compressors.YUICompressor')
+            _COMPRESSOR = load_class(path)()
+
+    return _COMPRESSOR
+
+def serve(compressor, stdin=sys.stdin, stdout=sys.stdout):
+    while True:
+        header = stdin.readline()
+        if not header:
+            break
+        file_type, length = header.split()
+        data = stdin.read(int(length))
+        try:
+            status, payload = 'OK', compressor.compress(data, file_type)
+        except CompressionError, e:
+            status, payload = 'ERR', str(e)
+        stdout.write('%s %d\n' % (status, len(payload)))
+        stdout.write(payload)
+        stdout.flush()
+
+if __name__ == '__main__':
+    serve(load_class(sys.argv[1])())
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import marshal
+from threading import Lock
+
+from django.conf import settings
+
+# Bump this when the format of the stored entries changes
+CACHE_VERSION = 2
+
+CACHE_NAME = '.bundles_hashcache'
+
+def file_signature(path):
+    # Python 2 has no st_mtime_ns, so derive it from the float mtime
+    st = os.stat(path)
+    return (st.st_size, int(st.st_mtime * 1000000000), st.st_ino)
+
+# Dictionary saved with marshal, which is fast to load. The entries are
+# dropped when the stored version differs from the given one.
+class MarshalCache(object):
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.entries = {}
+        self.dirty = False
+        self.lock = Lock()
+        self.load()
+
+    def load(self):
+        try:
+            fp = open(self.path, 'rb')
+            try:
+                version, entries = marshal.load(fp)
+            finally:
+                fp.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return
+
+        if version == self.version:
+            self.entries = entries
+
+    def save(self):
+        self.lock.acquire()
+        try:
+            if not self.dirty:
+                return
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            fp = open(tmp_path, 'wb')
+            try:
+                marshal.dump((self.version, self.entries), fp)
+            finally:
+                fp.close()
+            os.rename(tmp_path, self.path)
+            self.dirty = False
+        finally:
+            self.lock.release()
+
+    def set_entry(self, key, entry):
+        self.lock.acquire()
+        try:
+            self.entries[key] = entry
+            self.dirty = True
+        finally:
+            self.lock.release()
+
+# Maps (algorithm, path) to the digest of a source file. Entries are only
+# trusted while the (size, mtime_ns, inode) signature of the file is
+# unchanged.
+class HashCache(MarshalCache):
+    def __init__(self, path):
+        self.hits = 0
+        self.misses = 0
+        super(HashCache, self).__init__(path, CACHE_VERSION)
+
+    def get(self, key, signature):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == signature:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        return None
+
+    def set(self, key, signature, digest):
+        self.set_entry(key, (signature, digest))
+
+    def stats(self):
+        return 'Hash cache: %d hits, %d misses (%s)' % \
+            (self.hits, self.misses, self.path)
+
+_CACHE = None
+
+def get_hash_cache(base_dir=None):
+    global _CACHE
+    if _CACHE is None:
+        path = getattr(settings, 'BUNDLES_HASH_CACHE', None)
+        if path is False:
+            return None
+        if path is None:
+            if not base_dir:
+                return None
+            path = os.path.join(base_dir, CACHE_NAME)
+        _CACHE = HashCache(path)
+
+    return _CACHE
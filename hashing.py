@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Source hashing shared by all the bundles. Every file is hashed on its own
+# and its digest kept in the hash cache, so files used by several bundles
+# are only read once. The digest of a bundle is the digest of the digests
+# of its files, encoded with URL safe base64 and cut to
+# settings.BUNDLES_HASH_LENGTH characters. The algorithm is chosen with
+# settings.BUNDLES_HASH_ALGORITHM (any name accepted by hashlib.new()).
+#
+# prefetch() hashes many files at once using up to BUNDLES_HASH_THREADS
+# threads, since hashlib releases the GIL while hashing.
+
+import os
+import mmap
+import hashlib
+from base64 import urlsafe_b64encode
+from threading import Thread, Lock
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from bundles.hashcache import get_hash_cache, file_signature
+from bundles import stats
+
+# Files at least this big are mapped instead of read
+MMAP_THRESHOLD = 1024 * 1024
+# Files are hashed by several threads when they add up to this size
+PARALLEL_THRESHOLD = 4 * 1024 * 1024
+
+def get_algorithm():
+    return getattr(settings, 'BUNDLES_HASH_ALGORITHM', 'sha1')
+
+def new_digest():
+    algorithm = get_algorithm()
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        raise ImproperlyConfigured('Unsupported BUNDLES_HASH_ALGORITHM "%s"' % algorithm)
+
+def combine(digests):
+    # Returns the name hash for a bundle given the digests of its files
+    m = new_digest()
+    for digest in digests:
+        m.update(digest)
+    encoded = urlsafe_b64encode(m.digest()).strip('=')
+    length = getattr(settings, 'BUNDLES_HASH_LENGTH', None)
+    if length:
+        return encoded[:length]
+    return encoded
+
+def hash_file(path):
+    # Returns the digest of the file at path and its size
+    m = new_digest()
+    fp = open(path, 'rb')
+    try:
+        size = os.fstat(fp.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                m.update(data)
+            finally:
+                data.close()
+        else:
+            data = fp.read()
+            size = len(data)
+            m.update(data)
+    finally:
+        fp.close()
+    return m.digest(), size
+
+class MemoryCache(object):
+    # Used when the hash cache is disabled, kept only for this process
+    def __init__(self):
+        self.entries = {}
+        self.lock = Lock()
+
+    def get(self, key, signature):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        return None
+
+    def set(self, key, signature, digest):
+        self.lock.acquire()
+        try:
+            self.entries[key] = (signature, digest)
+        finally:
+            self.lock.release()
+
+class Hasher(object):
+    def __init__(self, cache=None, threads=None):
+        self.cache = cache or MemoryCache()
+        if threads is None:
+            threads = getattr(settings, 'BUNDLES_HASH_THREADS', 4)
+        self.threads = threads
+
+    def get_key(self, path):
+        return (get_algorithm(), path)
+
+    def lookup(self, path):
+        # Returns the cached digest for path and the signature it
+        # should be stored with when it's not cached
+        signature = file_signature(path)
+        return self.cache.get(self.get_key(path), signature), signature
+
+    def hash_file(self, path, signature=None):
+        # Returns the digest of path and the number of bytes read
+        digest, size = hash_file(path)
+        if signature is not None:
+            self.cache.set(self.get_key(path), signature, digest)
+        return digest, size
+
+    def get_digest(self, path):
+        try:
+            digest, signature = self.lookup(path)
+        except OSError:
+            digest, signature = None, None
+        if digest is not None:
+            return digest, 0
+        return self.hash_file(path, signature)
+
+    def hash_files(self, paths):
+        # Returns the name hash for a bundle with the given sources
+        # and the number of bytes read
+        digests = []
+        read = 0
+        for path in paths:
+            digest, size = self.get_digest(path)
+            digests.append(digest)
+            read += size
+        return combine(digests), read
+
+    def prefetch(self, paths):
+        # Hashes the files in paths which aren't cached, in parallel
+        pending = []
+        for path in set(paths):
+            try:
+                digest, signature = self.lookup(path)
+            except OSError:
+                # Reported when the bundle using it is validated
+                continue
+            if digest is None:
+                pending.append((path, signature))
+        if not pending:
+            return
+
+        timer = stats.Timer('(prefetch)', 'hash')
+        sizes = []
+        # Starting threads isn't worth it for a few small files
+        total = sum([signature[0] for path, signature in pending])
+        if self.threads > 1 and len(pending) > 1 and total >= PARALLEL_THRESHOLD:
+            pending = iter(pending)
+            lock = Lock()
+            workers = [Thread(target=self.prefetch_files, args=(pending, lock, sizes)) \
+                for ii in range(min(self.threads, total / MMAP_THRESHOLD + 1))]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        else:
+            self.prefetch_files(iter(pending), Lock(), sizes)
+        timer.stop(sum(sizes))
+
+    def prefetch_files(self, pending, lock, sizes):
+        while True:
+            lock.acquire()
+            try:
+                path, signature = pending.next()
+            except StopIteration:
+                return
+            finally:
+                lock.release()
+            try:
+                sizes.append(self.hash_file(path, signature)[1])
+            except (IOError, OSError):
+                # Reported when the bundle using it is hashed
+                pass
+
+_HASHER = None
+
+def get_hasher():
+    global _HASHER
+    cache = get_hash_cache()
+    if _HASHER is None or (cache is not None and _HASHER.cache is not cache):
+        _HASHER = Hasher(cache)
+    return _HASHER
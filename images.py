@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Lossless image optimization used by ImageBundle.compress(). PNG images
+# lose the ancillary chunks which don't change how they're displayed and
+# get their image data deflated again with the best zlib settings. GIF
+# images lose their comments and unknown application extensions. Anything
+# else (or anything which can't be parsed) is returned unchanged, as is
+# any image which doesn't get smaller.
+
+import zlib
+import struct
+
+# Bump this when the output changes, it's part of the cache key
+OPTIMIZER_VERSION = 1
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# Ancillary chunks affecting the displayed image
+PNG_KEEP = set(['tRNS', 'gAMA', 'cHRM', 'sRGB', 'iCCP', 'sBIT'])
+
+# Animated PNGs keep their frames in ancillary chunks
+PNG_ANIMATION = set(['acTL', 'fcTL', 'fdAT'])
+
+PNG_STRATEGIES = [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED]
+
+GIF_SIGNATURES = ('GIF87a', 'GIF89a')
+
+# Application extensions controlling animation
+GIF_KEEP_APPLICATIONS = ('NETSCAPE2.0', 'ANIMEXTS1.0')
+
+class ImageFormatError(ValueError):
+    pass
+
+def read_png_chunks(data):
+    pos = len(PNG_SIGNATURE)
+    chunks = []
+    while pos < len(data):
+        if pos + 8 > len(data):
+            raise ImageFormatError('Truncated PNG chunk')
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        end = pos + 8 + length
+        if end + 4 > len(data):
+            raise ImageFormatError('Truncated PNG chunk')
+        chunk_data = data[pos + 8:end]
+        crc = struct.unpack('>I', data[end:end + 4])[0]
+        if crc != zlib.crc32(chunk_type + chunk_data) & 0xffffffff:
+            raise ImageFormatError('Bad CRC in PNG chunk %r' % chunk_type)
+        chunks.append((chunk_type, chunk_data))
+        pos = end + 4
+        if chunk_type == 'IEND':
+            break
+    return chunks
+
+def write_png_chunk(chunk_type, chunk_data):
+    return struct.pack('>I4s', len(chunk_data), chunk_type) + chunk_data + \
+        struct.pack('>I', zlib.crc32(chunk_type + chunk_data) & 0xffffffff)
+
+def deflate(data):
+    # Returns the smallest zlib stream for data among the tried strategies
+    best = None
+    for strategy in PNG_STRATEGIES:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS, 9, strategy)
+        compressed = compressor.compress(data) + compressor.flush()
+        if best is None or len(compressed) < len(best):
+            best = compressed
+    return best
+
+def optimize_png(data):
+    chunks = read_png_chunks(data)
+    types = set([chunk_type for chunk_type, chunk_data in chunks])
+    if types & PNG_ANIMATION or 'IDAT' not in types or chunks[-1][0] != 'IEND':
+        return data
+
+    idat = ''.join([chunk_data for chunk_type, chunk_data in chunks if chunk_type == 'IDAT'])
+    try:
+        idat = deflate(zlib.decompress(idat))
+    except zlib.error, e:
+        raise ImageFormatError('Bad PNG image data: %s' % e)
+
+    output = [PNG_SIGNATURE]
+    for chunk_type, chunk_data in chunks:
+        if chunk_type == 'IDAT':
+            if idat is not None:
+                # All the image data goes in a single chunk
+                output.append(write_png_chunk('IDAT', idat))
+                idat = None
+        elif chunk_type[0].isupper() or chunk_type in PNG_KEEP:
+            output.append(write_png_chunk(chunk_type, chunk_data))
+
+    return ''.join(output)
+
+def skip_gif_blocks(data, pos):
+    # Returns the position after the data sub-blocks starting at pos
+    while True:
+        if pos >= len(data):
+            raise ImageFormatError('Truncated GIF data')
+        size = ord(data[pos])
+        pos += 1 + size
+        if size == 0:
+            return pos
+
+def optimize_gif(data):
+    if len(data) < 13:
+        raise ImageFormatError('Truncated GIF header')
+    flags = ord(data[10])
+    pos = 13
+    if flags & 0x80:
+        pos += 3 * (2 << (flags & 0x07))
+    output = [data[:pos]]
+    while True:
+        if pos >= len(data):
+            raise ImageFormatError('Truncated GIF data')
+        block = data[pos]
+        if block == '\x3b':
+            # Anything after the trailer is ignored by decoders
+            output.append(block)
+            break
+        elif block == '\x2c':
+            # Image descriptor, local color table and image data
+            if pos + 10 > len(data):
+                raise ImageFormatError('Truncated GIF image')
+            flags = ord(data[pos + 9])
+            end = pos + 10
+            if flags & 0x80:
+                end += 3 * (2 << (flags & 0x07))
+            end = skip_gif_blocks(data, end + 1)
+            output.append(data[pos:end])
+            pos = end
+        elif block == '\x21':
+            if pos + 2 > len(data):
+                raise ImageFormatError('Truncated GIF extension')
+            label = data[pos + 1]
+            end = skip_gif_blocks(data, pos + 2)
+            if label == '\xfe':
+                # Comment
+                pass
+            elif label == '\xff' and data[pos + 3:pos + 14] not in GIF_KEEP_APPLICATIONS:
+                # Application data (XMP metadata and the like)
+                pass
+            else:
+                output.append(data[pos:end])
+            pos = end
+        else:
+            raise ImageFormatError('Unknown GIF block 0x%02x' % ord(block))
+
+    return ''.join(output)
+
+def optimize(data):
+    # Returns the optimized image, or data if it can't be made smaller
+    try:
+        if data.startswith(PNG_SIGNATURE):
+            optimized = optimize_png(data)
+        elif data[:6] in GIF_SIGNATURES:
+            optimized = optimize_gif(data)
+        else:
+            return data
+    except ImageFormatError:
+        return data
+
+    if len(optimized) < len(data):
+        return optimized
+    return data
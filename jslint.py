@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Batched JSLint runs. Starting the JVM takes much longer than linting a
+# file, so jslint_batch.js lints many files with a single Rhino process and
+# up to "jobs" processes run at once. Results are cached by the digest of
+# every file (and the JSLint version and options), in
+# settings.BUNDLES_LINT_CACHE (.bundles_lintcache in the directory with
+# bundles.yaml by default, False disables it), so only changed files are
+# linted again. Options for JSLINT() are taken from the
+# settings.BUNDLES_JSLINT_OPTIONS dict.
+
+import os
+import hashlib
+import subprocess
+from threading import Thread, Lock
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from django.conf import settings
+
+from bundles.libbundler import LintError, RHINO_JAR, JSLINT
+from bundles.hashing import get_hasher
+from bundles.hashcache import MarshalCache
+
+# Bump this when the format of the stored entries changes
+CACHE_VERSION = 1
+
+CACHE_NAME = '.bundles_lintcache'
+
+DRIVER = 'jslint_batch.js'
+
+# Files linted by every Rhino process, at most
+BATCH_SIZE = 100
+
+class LintCache(MarshalCache):
+    # Maps (file digest, options) to the errors found in the file. Every
+    # entry is dropped when jslint.js changes.
+    def __init__(self, path, version):
+        super(LintCache, self).__init__(path, (CACHE_VERSION, version))
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, errors):
+        self.set_entry(key, errors)
+
+def get_options():
+    return json.dumps(getattr(settings, 'BUNDLES_JSLINT_OPTIONS', None), sort_keys=True)
+
+def get_lint_cache(base_dir, jslint):
+    path = getattr(settings, 'BUNDLES_LINT_CACHE', None)
+    if path is False:
+        return None
+    if path is None:
+        path = os.path.join(base_dir, CACHE_NAME)
+    fp = open(jslint, 'rb')
+    try:
+        version = hashlib.sha1(fp.read()).hexdigest()
+    finally:
+        fp.close()
+    return LintCache(path, version)
+
+class JSLint(object):
+    def __init__(self, rhino_jar=None, jslint=None, driver=None):
+        this_dir = os.path.dirname(os.path.abspath(__file__))
+        self.rhino_jar = rhino_jar or os.path.join(this_dir, RHINO_JAR)
+        self.jslint = jslint or os.path.join(this_dir, JSLINT)
+        self.driver = driver or os.path.join(this_dir, DRIVER)
+        self.options = get_options()
+
+    def missing(self):
+        # Returns a message explaining why files can't be linted
+        for path in (self.rhino_jar, self.jslint, self.driver):
+            if not os.path.exists(path):
+                return 'Cannot find "%s"' % path
+        return None
+
+    def lint_batch(self, paths):
+        # Returns {path: [error, ...]} for the given files, linted by a
+        # single Rhino process
+        command = ['java', '-jar', self.rhino_jar, self.driver, self.jslint,
+            self.options] + list(paths)
+        try:
+            p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, close_fds=True)
+        except OSError, e:
+            raise LintError('Cannot run java: %s' % e)
+        out, err = p.communicate()
+
+        results = []
+        for line in out.splitlines():
+            # Anything else is printed by Rhino itself
+            if not line.startswith('{'):
+                continue
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if 'error' in result:
+                raise LintError(result['error'])
+            results.append(result['errors'])
+        # Printed in the same order as the files were given
+        if p.returncode != 0 or len(results) != len(paths):
+            raise LintError('JSLint failed with status %d: %s' % \
+                (p.returncode, err.strip()))
+        return dict(zip(paths, results))
+
+    def run_batches(self, batches, results, failures, lock):
+        while True:
+            lock.acquire()
+            try:
+                batch = batches.next()
+            except StopIteration:
+                return
+            finally:
+                lock.release()
+            try:
+                results.update(self.lint_batch(batch))
+            except LintError, e:
+                failures.append(e)
+
+    def lint(self, paths, jobs=1, cache=None):
+        # Returns [(path, errors)] for every file in paths and the number
+        # of files taken from the cache
+        hasher = get_hasher()
+        keys = {}
+        results = {}
+        pending = []
+        cached = 0
+        for path in paths:
+            try:
+                keys[path] = (hasher.get_digest(path)[0], self.options)
+            except (IOError, OSError), e:
+                results[path] = [{'line': 0, 'character': 0,
+                    'reason': 'Cannot read file: %s' % e, 'evidence': ''}]
+                continue
+            errors = None
+            if cache is not None:
+                errors = cache.get(keys[path])
+            if errors is None:
+                pending.append(path)
+            else:
+                results[path] = errors
+                cached += 1
+
+        if pending:
+            # Split evenly between the processes, in batches of at most
+            # BATCH_SIZE files
+            count = max(min(jobs, len(pending)), (len(pending) - 1) / BATCH_SIZE + 1)
+            batches = iter([pending[ii::count] for ii in range(count)])
+            linted = {}
+            failures = []
+            lock = Lock()
+            workers = [Thread(target=self.run_batches, args=(batches, linted, failures, lock)) \
+                for ii in range(min(jobs, count))]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if failures:
+                raise failures[0]
+            for path in pending:
+                results[path] = linted[path]
+                if cache is not None:
+                    cache.set(keys[path], linted[path])
+
+        return [(path, results[path]) for path in paths], cached
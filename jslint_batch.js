@@ -0,0 +1,85 @@
+// Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+// Released under the same license as the rest of this application,
+// see COPYING.
+
+// Lints several files with a single Rhino process, used by jslint.py.
+//
+//   java -jar js.jar jslint_batch.js jslint.js options file.js...
+//
+// options is a JSON object passed to JSLINT() (or "null"). One JSON object
+// is printed for every file, in a line of its own:
+//
+//   {"file": "a.js", "errors": [{"line": 1, "character": 5,
+//       "reason": "Missing semicolon.", "evidence": "var a = 1"}]}
+
+/*global JSLINT, load, print, quit, readFile */
+
+(function (global, args) {
+    var stop = {}, realPrint = print, realQuit = quit, options, ii, jj,
+        source, errors, error, result;
+
+    function quote(value) {
+        var out = [], ch, code, kk;
+        value = String(value);
+        for (kk = 0; kk < value.length; kk += 1) {
+            ch = value.charAt(kk);
+            code = value.charCodeAt(kk);
+            if (ch === '"' || ch === '\\') {
+                out.push('\\' + ch);
+            } else if (code < 32 || code > 126) {
+                out.push('\\u' + ('0000' + code.toString(16)).slice(-4));
+            } else {
+                out.push(ch);
+            }
+        }
+        return '"' + out.join('') + '"';
+    }
+
+    // jslint.js for Rhino lints its arguments and quits once loaded, so
+    // it gets no arguments and quitting just stops loading it
+    global.arguments = [];
+    print = function () {};
+    quit = function () {
+        throw stop;
+    };
+    try {
+        load(args[0]);
+    } catch (e) {
+        if (e !== stop) {
+            throw e;
+        }
+    } finally {
+        print = realPrint;
+        quit = realQuit;
+    }
+    if (typeof JSLINT !== 'function') {
+        print('{"error": ' + quote('JSLINT is not defined by ' + args[0]) + '}');
+        quit(2);
+    }
+
+    options = eval('(' + args[1] + ')');
+    for (ii = 2; ii < args.length; ii += 1) {
+        errors = [];
+        try {
+            source = readFile(args[ii]);
+        } catch (e) {
+            source = null;
+            errors.push('{"line": 0, "character": 0, "reason": ' +
+                quote('Cannot read file: ' + e) + ', "evidence": ""}');
+        }
+        if (source !== null && !(options ? JSLINT(source, options) : JSLINT(source))) {
+            for (jj = 0; jj < JSLINT.errors.length; jj += 1) {
+                error = JSLINT.errors[jj];
+                // JSLint adds a null error when it stops early
+                if (error) {
+                    errors.push('{"line": ' + (error.line + 1) +
+                        ', "character": ' + (error.character + 1) +
+                        ', "reason": ' + quote(error.reason || '') +
+                        ', "evidence": ' + quote(error.evidence || '') + '}');
+                }
+            }
+        }
+        result = '{"file": ' + quote(args[ii]) + ', "errors": [' + errors.join(', ') + ']}';
+        print(result);
+    }
+}(this, arguments));
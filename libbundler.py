@@ -22,13 +22,25 @@
 
 import os
 import re
+import copy
 import yaml
-from base64 import urlsafe_b64encode
 import hashlib
+import gzip
+from cStringIO import StringIO
+from itertools import imap
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
 
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 
+from bundles.hashcache import get_hash_cache, file_signature
+from bundles.hashing import get_hasher, get_algorithm, new_digest, combine
+from bundles.artifacts import get_artifact_store, make_key
+from bundles import stats
+
 BUNDLE_TYPES = {}
 
 YUIC_VERSION = '2.3.6'
@@ -46,6 +58,12 @@ RHINO_URL = 'ftp://ftp.mozilla.org/pub/mozilla.org/js/%s.zip' % RHINO
 JSLINT = 'jslint.js'
 JSLINT_URL = 'http://www.jslint.com/rhino/%s' % JSLINT
 
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 3
+
+# Bundles merging others, written by butil.py from the usage statistics
+MERGED_CONF_NAME = 'bundles.merged.yaml'
+
 if hasattr(settings, 'BUNDLES_URL'):
     BUNDLES_URL = settings.BUNDLES_URL
 else:
@@ -54,6 +72,15 @@ else:
 def is_debug_mode():
     return settings.DEBUG and not getattr(settings, 'BUNDLES_NO_DEBUG', False)
 
+def get_integrity_algorithm():
+    # settings.BUNDLES_INTEGRITY is True (for sha384) or the algorithm name
+    algorithm = getattr(settings, 'BUNDLES_INTEGRITY', False)
+    if algorithm is True:
+        return 'sha384'
+    if algorithm and algorithm not in ('sha256', 'sha384', 'sha512'):
+        raise ImproperlyConfigured('Unsupported BUNDLES_INTEGRITY "%s"' % algorithm)
+    return algorithm or None
+
 class BundleError(RuntimeError):
     pass
 
@@ -69,6 +96,81 @@ class BundleParserError(BundleError):
 class BundleDoesNotExist(BundleError):
     pass
 
+class CompressionError(BundleError):
+    pass
+
+class CircularImportError(BundleError):
+    pass
+
+class LintError(BundleError):
+    pass
+
+# Size of the reads and writes when streaming bundles
+BUFFER_SIZE = 1024 * 1024
+
+def write_chunks(path, chunks):
+    # Bundle files may be hard links into the artifact store,
+    # so they're always replaced instead of being rewritten
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    fp = open(tmp_path, 'wb')
+    try:
+        for data in chunks:
+            fp.write(data)
+        fp.close()
+        os.rename(tmp_path, path)
+    except:
+        fp.close()
+        os.unlink(tmp_path)
+        raise
+
+def write_file(path, data):
+    return write_chunks(path, [data])
+
+def read_chunks(fp, digest=None, size=None):
+    # Yields the contents of fp (up to size bytes, if given) and closes
+    # it, updating digest if any
+    try:
+        while size is None or size > 0:
+            data = fp.read(size is None and BUFFER_SIZE or min(BUFFER_SIZE, size))
+            if not data:
+                break
+            if size is not None:
+                size -= len(data)
+            if digest is not None:
+                digest.update(data)
+            yield data
+    finally:
+        fp.close()
+
+def split_lines(chunks):
+    # Regroups chunks so every one ends at a line boundary, as needed to
+    # rewrite references (they never span lines). A line is never split,
+    # so memory is only bounded by the longest line.
+    rest = []
+    for data in chunks:
+        pos = data.rfind('\n') + 1
+        if not pos:
+            rest.append(data)
+            continue
+        rest.append(data[:pos])
+        yield ''.join(rest)
+        rest = [data[pos:]]
+    if ''.join(rest):
+        yield ''.join(rest)
+
+def tee_chunks(chunks, fp):
+    for data in chunks:
+        fp.write(data)
+        yield data
+
+def gzip_contents(contents, level):
+    # No file name and a fixed mtime, so equal inputs give equal outputs
+    buf = StringIO()
+    fp = gzip.GzipFile('', 'wb', level, buf, 0)
+    fp.write(contents)
+    fp.close()
+    return buf.getvalue()
+
 def get_bundle_type(bundle_name, bundle_dct):
     if bundle_dct and 'type' in bundle_dct:
         return bundle_dct['type']
@@ -82,8 +184,8 @@ def get_bundle_cls(bundle_name, bundle_dct):
         raise InvalidBundleType('No handler registered for "%s" bundles'  \
             % get_bundle_type(bundle_name, bundle_dct))
 
-def create_bundle(bundle_name, bundle_dct):
-    return get_bundle_cls(bundle_name, bundle_dct)(bundle_name, bundle_dct)
+def create_bundle(bundle_name, bundle_dct, digest=None):
+    return get_bundle_cls(bundle_name, bundle_dct)(bundle_name, bundle_dct, digest)
 
 class BundleType(type):
     def __init__(cls, name, bases, dct):
@@ -97,16 +199,22 @@ class BundleType(type):
 
 class BaseBundle(object):
     bundle_type = None
-    def __init__(self, name, dct):
+    # Whether the bundle gets a .gz sidecar when BUNDLES_GZIP is enabled
+    gzip = False
+    def __init__(self, name, dct, digest=None):
         self.name = name
-        self._hash = None
-        if dct and dct.get('files'):
-            self.files = dct['files']
+        self.options = dct or {}
+        self._hash = digest
+        self._markup = {}
+        if self.options.get('files'):
+            self.files = self.options['files']
         else:
             self.files = [self.name]
 
         self.bundle_name = self.get_bundle_name()
-        self.validate()
+        # Bundles restored from a manifest were validated when it was built
+        if digest is None:
+            self.validate()
 
     def validate(self):
         for fname in self.files:
@@ -116,72 +224,232 @@ class BaseBundle(object):
                 raise ImproperlyConfigured('File %s in bundle %s does not exist' % \
                     (fname, self.name))
 
+    def hash_sources(self):
+        return [self.get_source_name(fname) for fname in self.files]
+
     def hash(self):
-        m = hashlib.sha1()
-        for fname in self.files:
-            fp = open(self.get_source_name(fname))
-            m.update(fp.read())
-            fp.close()
+        timer = stats.Timer(self.name, 'hash')
+        digest, size = get_hasher().hash_files(self.hash_sources())
+        timer.stop(size)
+        return digest
 
-        return urlsafe_b64encode(m.digest()).strip('=')
+    def get_hash(self):
+        if self._hash is None:
+            self._hash = self.hash()
+        return self._hash
 
-    def rebuild(self):
+    def clone(self):
+        bundle = copy.copy(self)
+        bundle._markup = {}
+        return bundle
+
+    def invalidate(self):
+        self._hash = None
+        self._markup = {}
+
+    # Names of the bundles referenced by this one, part of its own name
+    # so it's renamed when any of them is. Set by link_bundles().
+    reference_names = ()
+
+    def set_reference_names(self, names):
+        # Returns True if the bundle got a new name
+        names = list(names)
+        if names == list(self.reference_names):
+            return False
+        self.reference_names = names
+        self._markup = {}
+        bundle_name = self.get_bundle_name()
+        renamed = bundle_name != self.bundle_name
+        self.bundle_name = bundle_name
+        return renamed
+
+    def get_identity(self):
+        # Options changing the contents besides the sources, as strings.
+        # They're part of the name and of the key of the built artifact.
+        return []
+
+    def get_name_hash(self):
+        extra = self.get_identity() + list(self.reference_names)
+        if not extra:
+            return self.get_hash()
+        return combine([self.get_hash()] + extra)
+
+    def refresh(self):
+        # Returns True if the sources changed, giving the bundle a new name
+        digest = self.hash()
+        if digest == self._hash:
+            return False
+        self.invalidate()
+        self._hash = digest
         self.bundle_name = self.get_bundle_name()
-        self.build()
+        return True
+
+    def rebuild(self):
+        self.refresh()
+        if self.build():
+            self.write_gzip()
 
     def get_source_name(self, fname):
         return os.path.join(settings.MEDIA_ROOT, fname)
 
+    def open_source(self, fname):
+        # Returns a file object with the contents added to the bundle for fname
+        return open(self.get_source_name(fname))
+
     def get_bundle_name(self):
         name_parts = self.name.rsplit('.', 1)
         if len(name_parts) == 1:
-            return '%s.%s' % (self.name, self.hash())
+            return '%s.%s' % (self.name, self.get_name_hash())
 
-        return '%s.%s.%s' % (name_parts[0], self.hash(), name_parts[1])
+        return '%s.%s.%s' % (name_parts[0], self.get_name_hash(), name_parts[1])
 
     @property
     def url(self):
-        return '%s/%s' % (BUNDLES_URL, self.get_bundle_name())
+        return '%s/%s' % (BUNDLES_URL, self.bundle_name)
 
     def get_bundle_path(self):
         return os.path.join(settings.MEDIA_ROOT, 'bundles', self.bundle_name)
 
-    def add_file(self, b_fp, s_fp):
-        data = s_fp.read(256)
-        while data:
-            b_fp.write(data)
-            data = s_fp.read(256)
-        s_fp.close()
+    # Written after every file
+    separator = ''
+    rewritten = False
+    # Value for the "as" attribute of preload links
+    preload_as = None
+    # Whether the markup can include an integrity attribute
+    supports_integrity = False
+    integrity = None
+
+    def read_sources(self, digests=None):
+        # Yields the contents of the bundle. If digests is a list, a
+        # digest of every source is appended to it.
+        for fname in self.files:
+            digest = None
+            if digests is not None:
+                digest = new_digest()
+                digests.append(digest)
+            for data in read_chunks(self.open_source(fname), digest):
+                yield data
+            if self.separator:
+                yield self.separator
+
+    def get_rewriter(self, other_bundles):
+        # Returns a function rewriting the references to other_bundles in
+        # a block of whole lines, or None if the bundle has no references
+        return None
 
-    def build(self, verbose=False):
-        if os.path.exists(self.get_bundle_path()):
+    def build(self, verbose=False, force=False, other_bundles=None):
+        # Sources are read once and streamed to the bundle, rewriting their
+        # references if other_bundles is given. In that case, rewritten
+        # tells if rereference() is still needed.
+        self.rewritten = False
+        if not force and os.path.exists(self.get_bundle_path()):
             return False
 
         bundle_dir = os.path.dirname(self.get_bundle_path())
         if not os.path.exists(bundle_dir):
-            os.makedirs(bundle_dir)
+            try:
+                os.makedirs(bundle_dir)
+            except OSError:
+                # Another process might have created it
+                if not os.path.isdir(bundle_dir):
+                    raise
         else:
             if not os.path.isdir(bundle_dir):
-                raise OSError('"%s" exists but is not a directory' % bundles_dir)
-        bundle = open(self.get_bundle_path(), 'w')
-        for fname in self.files:
-            source = open(self.get_source_name(fname))
-            self.add_file(bundle, source)
-        bundle.close()
+                raise OSError('"%s" exists but is not a directory' % bundle_dir)
+        store = get_artifact_store()
+        if store is not None:
+            key = make_key('build', self.__class__.__name__, self.get_hash(),
+                *self.get_identity())
+            if store.fetch(key, self.get_bundle_path()):
+                return True
+        # The store keeps the sources before rewriting them, hashed on the
+        # way to make sure they didn't change since the bundle was named
+        digests = None
+        if store is not None and self.hash_sources() == \
+            [self.get_source_name(fname) for fname in self.files]:
+            digests = []
+        chunks = self.read_sources(digests)
+        rewrite = other_bundles is not None and self.get_rewriter(other_bundles)
+        raw_path = raw = None
+        if rewrite:
+            if store is not None:
+                raw_path = '%s.%d.raw' % (self.get_bundle_path(), os.getpid())
+                raw = open(raw_path, 'wb')
+                chunks = tee_chunks(chunks, raw)
+            chunks = imap(rewrite, split_lines(chunks))
+        try:
+            # Written under a temporary name, so other processes never see
+            # partial bundles and forced builds don't modify files linked
+            # from the artifact store
+            write_chunks(self.get_bundle_path(), chunks)
+            if raw is not None:
+                raw.close()
+            if store is not None and (digests is None or \
+                combine([digest.digest() for digest in digests]) == self.get_hash()):
+                store.put(key, raw_path or self.get_bundle_path())
+        finally:
+            if raw is not None:
+                raw.close()
+                os.unlink(raw_path)
+        self.rewritten = bool(rewrite)
+        return True
+
+    def get_gzip_path(self):
+        return self.get_bundle_path() + '.gz'
+
+    def write_gzip(self):
+        if not self.gzip or not getattr(settings, 'BUNDLES_GZIP', False):
+            return False
+
+        contents = self.get_contents()
+        level = getattr(settings, 'BUNDLES_GZIP_LEVEL', 9)
+        min_saving = getattr(settings, 'BUNDLES_GZIP_MIN_SAVING', 512)
+        gzip_path = self.get_gzip_path()
+        store = get_artifact_store()
+        if store is not None:
+            key = make_key('gzip', level, hashlib.sha1(contents).hexdigest())
+            if store.fetch(key, gzip_path):
+                return True
+        data = gzip_contents(contents, level)
+        if len(contents) - len(data) < min_saving:
+            # Don't leave behind a sidecar for previous contents
+            if os.path.exists(gzip_path):
+                os.unlink(gzip_path)
+            return False
+        write_file(gzip_path, data)
+        if store is not None:
+            store.put(key, gzip_path)
         return True
 
+    def cached_markup(self, key, builder):
+        # Markup only depends on the bundle identity, which is reset
+        # by invalidate() when the contents change
+        markup = self._markup.get(key)
+        if markup is None:
+            markup = self._markup[key] = builder()
+        return markup
+
     def include_debug(self, base_url=''):
-        markup = []
-        for file_name in self.files:
-            markup.append(self.include_file(base_url + settings.MEDIA_URL + file_name))
+        def builder():
+            # Concatenated on every request by bundles.views.serve_debug,
+            # at the same depth as the bundle so relative urls still work
+            if getattr(settings, 'BUNDLES_DEBUG_CONCATENATE', False):
+                return self.include_file(base_url + BUNDLES_URL + self.name + '?debug')
+            markup = []
+            for file_name in self.files:
+                markup.append(self.include_file(base_url + settings.MEDIA_URL + file_name))
 
-        return u'\n'.join(markup)
+            return u'\n'.join(markup)
+        return self.cached_markup(('debug', base_url), builder)
 
     def include_release(self, base_url=''):
-        return self.include_file(base_url + BUNDLES_URL + self.bundle_name)
+        return self.cached_markup(('release', base_url),
+            lambda: self.include_file(base_url + BUNDLES_URL + self.bundle_name,
+                self.get_integrity_attributes()))
 
     def include_external(self):
-        return self.include(base_url='http://' + settings.SITE_NAME)
+        return self.cached_markup(('external', ),
+            lambda: self.include(base_url='http://' + settings.SITE_NAME))
 
     def compress(self, verbose=False):
         pass
@@ -193,13 +461,45 @@ class BaseBundle(object):
         return contents
 
     def set_contents(self, contents):
-        fp = open(self.get_bundle_path(), 'w')
-        fp.write(contents)
-        fp.close()
+        write_file(self.get_bundle_path(), contents)
 
     def rereference(self, other_bundles):
         pass
 
+    def get_references(self, other_bundles):
+        # Names of the bundles referenced by this one
+        return set()
+
+    def compute_integrity(self):
+        # Subresource Integrity value for the contents of the bundle
+        algorithm = get_integrity_algorithm()
+        if not algorithm or not self.supports_integrity:
+            return None
+        m = hashlib.new(algorithm)
+        try:
+            for data in read_chunks(open(self.get_bundle_path(), 'rb')):
+                m.update(data)
+        except IOError:
+            return None
+        return '%s-%s' % (algorithm, m.digest().encode('base64').replace('\n', ''))
+
+    def set_integrity(self, integrity):
+        if integrity != self.integrity:
+            self.integrity = integrity
+            self._markup = {}
+
+    def get_integrity(self):
+        # Computed when the bundle is built, this is only a fallback
+        if self.integrity is None:
+            self.integrity = self.compute_integrity()
+        return self.integrity
+
+    def get_integrity_attributes(self):
+        integrity = self.get_integrity()
+        if integrity is None:
+            return u''
+        return u' integrity="%s" crossorigin="anonymous"' % integrity
+
 
 if is_debug_mode():
     BaseBundle.include = BaseBundle.include_debug
@@ -209,87 +509,729 @@ else:
 class Bundle(BaseBundle):
     __metaclass__ = BundleType
 
+def names_pattern(names):
+    # Builds a regex matching any of the names from a trie of their
+    # characters, so matching doesn't try every name at every position.
+    # Longer names are preferred when one name is a prefix of another.
+    trie = {}
+    for name in names:
+        node = trie
+        for char in name:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def build(node):
+        branches = []
+        for char in sorted(node):
+            if char:
+                branches.append(re.escape(char) + build(node[char]))
+        if not branches:
+            return ''
+        if len(branches) == 1:
+            pattern = branches[0]
+        else:
+            pattern = '(?:%s)' % '|'.join(branches)
+        if '' in node:
+            return '(?:%s)?' % pattern
+        return pattern
+
+    return build(trie)
+
+class ReferenceMatcher(object):
+    def __init__(self, delimiters, names):
+        self.delimiters = list(delimiters)
+        self.regex = None
+        if not names:
+            return
+        alternatives = names_pattern(names)
+        patterns = []
+        for start, end in self.delimiters:
+            patterns.append('%s(.*?)(%s)%s' % \
+                (re.escape(start), alternatives, re.escape(end)))
+        self.regex = re.compile('|'.join(patterns))
+
+    def rewrite(self, contents, bundles, exclude=None):
+        # Returns the rewritten contents and the names of the referenced bundles
+        referenced = set()
+        if self.regex is None:
+            return contents, referenced
+
+        def replace(match):
+            for ii, (start, end) in enumerate(self.delimiters):
+                name = match.group(ii * 2 + 2)
+                if name is not None:
+                    break
+            if name == exclude:
+                return match.group(0)
+            referenced.add(name)
+            return '%s%s%s%s' % (start, match.group(ii * 2 + 1),
+                'bundles/' + bundles[name].bundle_name, end)
+
+        return self.regex.sub(replace, contents), referenced
+
+_MATCHERS = {}
+
+def get_reference_matcher(delimiters, bundles):
+    key = (tuple(delimiters), tuple(sorted(bundles.keys())))
+    try:
+        return _MATCHERS[key]
+    except KeyError:
+        pass
+    if len(_MATCHERS) > 16:
+        _MATCHERS.clear()
+    matcher = _MATCHERS[key] = ReferenceMatcher(delimiters, key[1])
+    return matcher
+
 class YUIBundle(Bundle):
     reference_delimiters = []
-    def add_file(self, b_fp, s_fp):
-        super(YUIBundle, self).add_file(b_fp, s_fp)
-        b_fp.write('\n\n')
+    gzip = True
+    separator = '\n\n'
+
+    def invalidate(self):
+        # The sources changed, so they're looked for again
+        super(YUIBundle, self).invalidate()
+        self.references = None
 
     def compress(self, verbose=False):
-        this_dir = os.path.dirname(os.path.abspath(__file__))
-        yuic_jar = os.path.join(this_dir, YUIC_JAR)
-        if not os.path.exists(yuic_jar):
-            print 'Cannot find "%s"' % yuic_jar
+        from bundles.compressors import get_compressor
+        compressor = get_compressor()
+        missing = compressor.missing()
+        if missing:
+            print missing
             return
-        fname = self.get_bundle_path()
-        p = os.popen('java -jar %s --type %s -v %s -o %s 2>&1' %
-            (yuic_jar, self.file_type, fname, fname))
-        out = p.read()
-        if verbose:
-            print out
+        contents = self.get_contents()
+        store = get_artifact_store()
+        if store is not None:
+            key = make_key('compress', self.file_type, compressor,
+                compressor.options, hashlib.sha1(contents).hexdigest())
+            if store.fetch(key, self.get_bundle_path()):
+                return
+        try:
+            contents = compressor.compress(contents, self.file_type, verbose)
+        except CompressionError, e:
+            raise CompressionError('Cannot compress bundle %s: %s' % (self.name, e))
+        self.set_contents(contents)
+        if store is not None:
+            store.put(key, self.get_bundle_path())
+
+    references = None
+
+    def get_rewriter(self, other_bundles):
+        self.references = set()
+        return lambda contents: self.rewrite_references(contents, other_bundles)
+
+    def rewrite_references(self, contents, other_bundles):
+        # Rewrites a block of whole lines, adding the bundles it
+        # references to self.references
+        if self.reference_delimiters:
+            matcher = get_reference_matcher(self.reference_delimiters, other_bundles)
+            contents, references = matcher.rewrite(contents, other_bundles, self.name)
+            self.references.update(references)
+        return contents.replace('../bundles/', '')
+
+    def get_text_sources(self):
+        # Hashed sources which can reference other bundles
+        return self.hash_sources()
 
-    def escape(self, value):
-        return value.replace('(', '\(').replace(')', '\)')
+    def get_references(self, other_bundles):
+        if self.references is None:
+            # Not rereferenced by this process, look for them in the sources
+            references = set()
+            if self.reference_delimiters:
+                matcher = get_reference_matcher(self.reference_delimiters, other_bundles)
+                for source in self.get_text_sources():
+                    fp = open(source)
+                    references.update(matcher.rewrite(fp.read(), other_bundles, self.name)[1])
+                    fp.close()
+            self.references = references
+        return self.references
 
     def rereference(self, other_bundles):
-        contents = self.get_contents()
-        for dlm in self.reference_delimiters:
-            for bundle in other_bundles.values():
-                if bundle == self:
-                    continue
-                r = re.compile('%s(.*?)%s%s' % (self.escape(dlm[0]), bundle.name, self.escape(dlm[1])))
-                contents = r.sub('%s\g<1>%s%s' % (dlm[0], 'bundles/' + bundle.bundle_name, dlm[1]), contents)
-        self.set_contents(contents.replace('../bundles/', ''))
+        rewrite = self.get_rewriter(other_bundles)
+        path = self.get_bundle_path()
+        blocks = split_lines(read_chunks(open(path, 'rb')))
+        # Nothing is written until a block actually changes, the
+        # unchanged ones before it are then copied from the bundle
+        offset = 0
+        for block in blocks:
+            rewritten = rewrite(block)
+            if rewritten != block:
+                break
+            offset += len(block)
+        else:
+            return
+
+        def chunks():
+            for data in read_chunks(open(path, 'rb'), size=offset):
+                yield data
+            yield rewritten
+            for block in blocks:
+                yield rewrite(block)
+
+        write_chunks(path, chunks())
 
 class JSBundle(YUIBundle):
     reference_delimiters = [ ('\'', '\''), ('"', '"') ]
     bundle_type = 'js'
     file_type = 'js'
-    def include_file(self, url):
-        return u'<script type="text/javascript" src="%s"></script>' % url
+    preload_as = 'script'
+    supports_integrity = True
+    def include_file(self, url, attributes=u''):
+        return u'<script type="text/javascript" src="%s"%s></script>' % (url, attributes)
+
+DATA_URI_TYPES = {
+    'gif': 'image/gif',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'ico': 'image/x-icon',
+}
+
+CSS_URL_RE = re.compile(r'url\(\s*([\'"]?)([^\'"()\s]+)\1\s*\)')
+
+CSS_IMPORT_RE = re.compile(r'@import\s+(?:url\(\s*([\'"]?)([^\'"()\s]+)\1\s*\)|' \
+    r'([\'"])([^\'"]+)\3)\s*([^;]*?)\s*;')
+CSS_CHARSET_RE = re.compile(r'@charset\s+[\'"][^\'"]*[\'"]\s*;')
+
+_DATA_URIS = {}
+
+def get_data_uri(path):
+    fp = open(path, 'rb')
+    data = fp.read()
+    fp.close()
+    # Encoded images are cached by the hash of their contents
+    key = (path.rsplit('.', 1)[-1].lower(), hashlib.sha1(data).hexdigest())
+    try:
+        return _DATA_URIS[key]
+    except KeyError:
+        pass
+    if len(_DATA_URIS) > 1024:
+        _DATA_URIS.clear()
+    uri = _DATA_URIS[key] = 'data:%s;base64,%s' % (DATA_URI_TYPES[key[0]],
+        data.encode('base64').replace('\n', ''))
+    return uri
+
+def is_relative_url(url):
+    return not (':' in url or url.startswith('/') or url.startswith('#'))
+
+def rebase_urls(contents, path, base_dir):
+    # Makes the relative url()s in contents, which were relative to
+    # the directory of path, relative to base_dir
+    directory = os.path.dirname(path)
+    if directory == base_dir:
+        return contents
+
+    def replace(match):
+        quote, url = match.groups()
+        if not is_relative_url(url):
+            return match.group(0)
+        split = len(url)
+        for char in '?#':
+            if char in url:
+                split = min(split, url.index(char))
+        rebased = os.path.relpath(os.path.join(directory, url[:split]), base_dir)
+        return 'url(%s%s%s)' % (quote, rebased.replace(os.sep, '/') + url[split:], quote)
+
+    return CSS_URL_RE.sub(replace, contents)
+
+def resolve_css_url(url, directory):
+    # Returns the path of the file under MEDIA_ROOT referenced by url in
+    # a stylesheet in directory, or None
+    path = url.split('?', 1)[0].split('#', 1)[0]
+    if path.startswith(settings.MEDIA_URL):
+        path = os.path.join(settings.MEDIA_ROOT, path[len(settings.MEDIA_URL):])
+    elif is_relative_url(path):
+        path = os.path.join(directory, path)
+    else:
+        return None
+    path = os.path.normpath(path)
+    if os.path.relpath(path, settings.MEDIA_ROOT).startswith(os.pardir):
+        return None
+    return path
+
+_CSS_IMAGES = {}
+
+def get_css_images(path):
+    # Returns the paths of the images which could be inlined in the
+    # stylesheet at path, cached until the file changes
+    try:
+        signature = file_signature(path)
+    except OSError:
+        return []
+    cached = _CSS_IMAGES.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    fp = open(path)
+    contents = fp.read()
+    fp.close()
+    images = []
+    for match in CSS_URL_RE.finditer(contents):
+        image = resolve_css_url(match.group(2), os.path.dirname(path))
+        if image is not None and image not in images and \
+            image.rsplit('.', 1)[-1].lower() in DATA_URI_TYPES and os.path.isfile(image):
+            images.append(image)
+    _CSS_IMAGES[path] = (signature, images)
+    return images
+
+_CSS_IMPORTS = {}
+
+def get_css_imports(path):
+    # Returns (match, path) for every local file imported by the
+    # stylesheet at path, cached until the file changes
+    try:
+        signature = file_signature(path)
+    except OSError:
+        return []
+    cached = _CSS_IMPORTS.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    fp = open(path)
+    contents = fp.read()
+    fp.close()
+    imports = []
+    for match in CSS_IMPORT_RE.finditer(contents):
+        url = match.group(2) or match.group(4)
+        if is_relative_url(url):
+            imported = os.path.normpath(os.path.join(os.path.dirname(path), url))
+            if os.path.isfile(imported):
+                imports.append(imported)
+    _CSS_IMPORTS[path] = (signature, imports)
+    return imports
 
 class CSSBundle(YUIBundle):
     reference_delimiters = [ ('url(', ')') ]
     bundle_type = 'css'
     file_type = 'css'
+    preload_as = 'style'
+    supports_integrity = True
     media = 'screen'
-    def __init__(self, name, dct):
-        super(CSSBundle, self).__init__(name, dct)
-        self.media = dct.get('media', self.media)
+    # Images up to this size are replaced by data URIs, 0 disables it
+    inline_max_bytes = 0
+    def __init__(self, name, dct, digest=None):
+        # Needed by hash_sources() when the bundle name is computed
+        self.flatten_imports = bool((dct or {}).get('flatten_imports',
+            self.flatten_imports))
+        self.inline_max_bytes = int((dct or {}).get('inline_max_bytes',
+            self.inline_max_bytes))
+        super(CSSBundle, self).__init__(name, dct, digest)
+        self.media = self.options.get('media', self.media)
+
+    # Whether relative @imports are replaced by the imported files
+    flatten_imports = False
+
+    def get_identity(self):
+        identity = super(CSSBundle, self).get_identity()
+        if self.flatten_imports:
+            identity.append('flatten_imports')
+        if self.inline_max_bytes:
+            identity.append('inline_max_bytes=%d' % self.inline_max_bytes)
+        return identity
+
+    def get_text_sources(self):
+        sources = super(CSSBundle, self).hash_sources()
+        if not self.flatten_imports:
+            return sources
+        # Imported files are part of the bundle, so they're hashed and watched
+        found = list(sources)
+        pending = list(sources)
+        while pending:
+            for imported in get_css_imports(pending.pop(0)):
+                if imported not in found:
+                    found.append(imported)
+                    pending.append(imported)
+        return found
+
+    def hash_sources(self):
+        sources = self.get_text_sources()
+        if not self.inline_max_bytes:
+            return sources
+        # So are the images which might be inlined, whatever their size
+        found = list(sources)
+        for source in sources:
+            for image in get_css_images(source):
+                if image not in found:
+                    found.append(image)
+        return found
+
+    def invalidate(self):
+        super(CSSBundle, self).invalidate()
+        self.inlined = None
+
+    def build(self, verbose=False, force=False, other_bundles=None):
+        # Found again when the sources are read, or by get_inlined()
+        self.inlined = None
+        return super(CSSBundle, self).build(verbose, force, other_bundles)
+
+    def read_sources(self, digests=None):
+        # Files imported more than once are only included the first time
+        # they're read, every time the bundle is read (clones included)
+        self.imported = set()
+        self.inlined = []
+        return super(CSSBundle, self).read_sources(digests)
+
+    def open_source(self, fname):
+        if not self.flatten_imports and not self.inline_max_bytes:
+            return super(CSSBundle, self).open_source(fname)
+        path = os.path.normpath(self.get_source_name(fname))
+        if self.flatten_imports:
+            if (path, '') in self.imported:
+                return StringIO('')
+            self.imported.add((path, ''))
+            kept = []
+            contents = self.flatten(path, os.path.dirname(path), [path], kept)
+            if kept:
+                # @imports are ignored by browsers after any other rule
+                match = CSS_CHARSET_RE.match(contents)
+                pos = match and match.end() or 0
+                contents = '%s\n%s\n%s' % (contents[:pos], '\n'.join(kept), contents[pos:])
+        else:
+            fp = open(path)
+            contents = fp.read()
+            fp.close()
+        if self.inline_max_bytes:
+            # The url()s are relative to this file (flattened imports
+            # are rebased to it)
+            timer = stats.Timer(self.name, 'inline')
+            size = len(contents)
+            contents, inlined = self.inline_images(contents, os.path.dirname(path))
+            timer.stop(size, len(contents))
+            self.inlined.extend(inlined)
+        return StringIO(contents)
+
+    def flatten(self, path, base_dir, stack, kept):
+        # Returns the contents of path with its relative @imports
+        # replaced by the imported files and its url()s relative to base_dir.
+        # The @imports which can't be flattened are appended to kept.
+        fp = open(path)
+        contents = fp.read()
+        fp.close()
+        parts = []
+        pos = 0
+        for match in CSS_IMPORT_RE.finditer(contents):
+            parts.append(rebase_urls(contents[pos:match.start()], path, base_dir))
+            parts.append(self.flatten_import(match, path, base_dir, stack, kept))
+            pos = match.end()
+        parts.append(rebase_urls(contents[pos:], path, base_dir))
+        return ''.join(parts)
+
+    def flatten_import(self, match, path, base_dir, stack, kept):
+        url = match.group(2) or match.group(4)
+        media = match.group(5)
+        imported = None
+        if is_relative_url(url):
+            imported = os.path.normpath(os.path.join(os.path.dirname(path), url))
+        if imported is None or not os.path.isfile(imported):
+            # Left for the browser
+            kept.append(match.group(0))
+            return ''
+        if imported in stack:
+            raise CircularImportError('Circular @import in bundle %s: %s' % \
+                (self.name, ' -> '.join(stack + [imported])))
+        if (imported, media) in self.imported:
+            return ''
+        self.imported.add((imported, media))
+        contents = CSS_CHARSET_RE.sub('', self.flatten(imported, base_dir,
+            stack + [imported], kept))
+        if media:
+            return '@media %s {\n%s\n}' % (media, contents)
+        return contents
+
+    inlined = None
+
+    def get_inline_source(self, url, directory):
+        # Returns the path of the image referenced by url in a stylesheet
+        # in directory and its size, or None if it can't be inlined
+        path = resolve_css_url(url, directory)
+        if path is None or path.rsplit('.', 1)[-1].lower() not in DATA_URI_TYPES:
+            return None
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        if size > self.inline_max_bytes:
+            return None
+        return path, size
+
+    def inline_images(self, contents, directory):
+        # Returns the contents with the small images replaced by data URIs
+        # and a list of (image, size) for every inlined image, with the
+        # images relative to MEDIA_ROOT
+        inlined = []
 
-    def include_file(self, url):
-        return u'<link href="%s" media="%s" rel="stylesheet" type="text/css" />' % \
-            (url, self.media)
+        def replace(match):
+            found = self.get_inline_source(match.group(2), directory)
+            if found is None:
+                return match.group(0)
+            path, size = found
+            image = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+            inlined.append((image, size))
+            return 'url(%s)' % get_data_uri(path)
+
+        return CSS_URL_RE.sub(replace, contents), inlined
+
+    def get_inlined(self):
+        # Images inlined in this bundle, as a list of (image, size)
+        if self.inlined is None:
+            if self.inline_max_bytes:
+                # Filled while the sources are read
+                for data in self.read_sources():
+                    pass
+            else:
+                self.inlined = []
+        return self.inlined
+
+    def get_references(self, other_bundles):
+        references = super(CSSBundle, self).get_references(other_bundles)
+        if self.inline_max_bytes:
+            # Still rebuilt when an inlined image bundle changes
+            references.update([image for image, size in self.get_inlined() \
+                if isinstance(other_bundles.get(image), ImageBundle)])
+        return references
+
+    def include_file(self, url, attributes=u''):
+        return u'<link href="%s" media="%s" rel="stylesheet" type="text/css"%s />' % \
+            (url, self.media, attributes)
 
 class ImageBundle(Bundle):
     file_type = 'img'
     bundle_type = ['gif', 'jpg', 'png', 'svg', 'ico']
+    preload_as = 'image'
+    def __init__(self, name, dct, digest=None):
+        super(ImageBundle, self).__init__(name, dct, digest)
+        # Only SVG images are text
+        self.gzip = get_bundle_type(name, dct) == 'svg'
+
     def validate(self):
         super(ImageBundle, self).validate()
         if len(self.files) > 1:
             raise ImproperlyConfigured('This type of bundle can only contain one file (%s)' % self.name)
 
-    def include_file(self, url):
+    def compress(self, verbose=False):
+        from bundles.images import optimize, OPTIMIZER_VERSION
+        contents = self.get_contents()
+        # Optimized images are cached by the hash of the original
+        store = get_artifact_store()
+        if store is not None:
+            key = make_key('image', OPTIMIZER_VERSION, hashlib.sha1(contents).hexdigest())
+            if store.fetch(key, self.get_bundle_path()):
+                return
+        optimized = optimize(contents)
+        if optimized is not contents:
+            self.set_contents(optimized)
+            if verbose:
+                print 'Optimized %s from %d to %d bytes' % (self.name,
+                    len(contents), len(optimized))
+        if store is not None:
+            store.put(key, self.get_bundle_path())
+
+    def include_file(self, url, attributes=u''):
         return u'<img alt="" src="%s" />' % url
 
 class IconBundle(Bundle):
     file_type = 'ico'
     bundle_type = 'ico'
-    def include_file(self, url):
+    def include_file(self, url, attributes=u''):
         return u'<link rel="icon shortcut" href="%s" type="image/x-icon" />' % url
 
-def get_bundles(base_dir):
-    bundles = {}
+def load_bundles_conf(base_dir):
     try:
         fp = open(os.path.join(base_dir, 'bundles.yaml'))
         raw_bundles = yaml.load(fp.read())
-    except OSError:
+    except (IOError, OSError):
         raise NoBundlesError('Cannot open bundles.yaml')
 
     fp.close()
+    try:
+        fp = open(os.path.join(base_dir, MERGED_CONF_NAME))
+        try:
+            merged = yaml.load(fp.read()) or {}
+        finally:
+            fp.close()
+    except (IOError, OSError):
+        merged = {}
+    for name, dct in merged.iteritems():
+        entry = expand_merged(name, dct, raw_bundles)
+        if entry is not None:
+            raw_bundles[name] = entry
+
+    return raw_bundles
+
+def get_merge_group(name, dct):
+    # Bundles can only be merged with other bundles in the same group,
+    # or None for bundles which can't be merged
+    try:
+        cls = get_bundle_cls(name, dct)
+    except InvalidBundleType:
+        return None
+    if not issubclass(cls, YUIBundle):
+        return None
+    options = dict(dct or {})
+    for key in ('files', 'type', 'merge'):
+        options.pop(key, None)
+    options.setdefault('media', getattr(cls, 'media', None))
+    return (cls.file_type, json.dumps(options, sort_keys=True))
+
+def expand_merged(name, dct, raw_bundles):
+    # Returns the definition of a merged bundle, with the files of its
+    # members, or None if they can't be merged anymore
+    members = (dct or {}).get('merge') or []
+    if len(members) < 2 or name in raw_bundles:
+        return None
+    groups = set()
+    files = []
+    for member in members:
+        if member not in raw_bundles:
+            return None
+        member_dct = raw_bundles[member] or {}
+        groups.add(get_merge_group(member, member_dct))
+        files.extend(member_dct.get('files') or [member])
+    if len(groups) != 1 or None in groups:
+        return None
+
+    entry = dict(raw_bundles[members[0]] or {})
+    entry['files'] = files
+    entry['merge'] = list(members)
+    return entry
+
+def get_bundles(base_dir, previous=None):
+    # Bundles in previous whose definition didn't change are reused
+    bundles = {}
+    cache = get_hash_cache(base_dir)
+    raw_bundles = load_bundles_conf(base_dir)
+    created = {}
     for key, value in raw_bundles.iteritems():
+        if previous and key in previous and previous[key].options == (value or {}):
+            bundles[key] = previous[key]
+        else:
+            created[key] = value
+
+    # Hash the files of the new bundles at once, each of them only once
+    sources = []
+    for key, value in created.iteritems():
+        for fname in (value or {}).get('files') or [key]:
+            sources.append(os.path.join(settings.MEDIA_ROOT, fname))
+    get_hasher().prefetch(sources)
+    for key, value in created.iteritems():
         bundles[key] = create_bundle(key, value)
 
+    link_bundles(bundles, copy=bool(previous))
+    if cache is not None:
+        try:
+            cache.save()
+        except (IOError, OSError):
+            pass
+
+    return bundles
+
+def link_bundles(bundles, names=None, get_references=None, copy=False):
+    # Gives every bundle in names (all of them by default) a name
+    # depending on the names of the bundles it references, following the
+    # references first. Returns the names of the renamed bundles. With
+    # copy, they're replaced by clones in bundles.
+    if get_references is None:
+        get_references = lambda name: bundles[name].get_references(bundles)
+    renamed = []
+    done = set()
+    visiting = set()
+
+    def visit(name):
+        if name in done or name in visiting:
+            return
+        visiting.add(name)
+        references = sorted([ref for ref in get_references(name) \
+            if ref != name and ref in bundles])
+        for ref in references:
+            visit(ref)
+        # A bundle closing a cycle of references only counts by its sources
+        reference_names = [ref in visiting and bundles[ref].get_hash() or \
+            bundles[ref].bundle_name for ref in references]
+        visiting.remove(name)
+        done.add(name)
+        bundle = bundles[name]
+        if list(bundle.reference_names) != reference_names:
+            if copy:
+                bundle = bundles[name] = bundle.clone()
+            if bundle.set_reference_names(reference_names):
+                renamed.append(name)
+
+    if names is None:
+        names = bundles.keys()
+    for name in sorted(names):
+        visit(name)
+    return renamed
+
+def get_manifest_path():
+    return os.path.join(settings.MEDIA_ROOT, 'bundles', MANIFEST_NAME)
+
+def get_source_signature(base_dir):
+    st = os.stat(os.path.join(base_dir, 'bundles.yaml'))
+    signature = [st.st_size, st.st_mtime]
+    try:
+        st = os.stat(os.path.join(base_dir, MERGED_CONF_NAME))
+        signature.extend([st.st_size, st.st_mtime])
+    except OSError:
+        pass
+    return signature
+
+def get_hashing():
+    # Bundle names hashed with other settings can't be reused
+    return [get_algorithm(), getattr(settings, 'BUNDLES_HASH_LENGTH', None)]
+
+def write_manifest(base_dir, bundles):
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'source': get_source_signature(base_dir),
+        'hashing': get_hashing(),
+        'bundles': {},
+    }
+    for name, bundle in bundles.iteritems():
+        entry = {
+            'type': get_bundle_type(name, bundle.options),
+            'files': bundle.files,
+            'options': bundle.options,
+            'hash': bundle.get_hash(),
+            'bundle_name': bundle.bundle_name,
+            'references': list(bundle.reference_names),
+            'integrity': bundle.integrity,
+        }
+        if hasattr(bundle, 'media'):
+            entry['media'] = bundle.media
+        manifest['bundles'][name] = entry
+
+    write_file(get_manifest_path(), json.dumps(manifest))
+
+def load_manifest(base_dir):
+    try:
+        fp = open(get_manifest_path())
+        try:
+            manifest = json.load(fp)
+        finally:
+            fp.close()
+        source = get_source_signature(base_dir)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION or \
+        manifest.get('source') != source or \
+        manifest.get('hashing') != get_hashing():
+        return None
+
+    bundles = {}
+    for name, entry in manifest['bundles'].iteritems():
+        try:
+            cls = BUNDLE_TYPES[entry['type']]
+        except KeyError:
+            return None
+        bundle = cls(name, entry['options'], entry['hash'])
+        bundle.set_reference_names(entry['references'])
+        if bundle.bundle_name != entry['bundle_name']:
+            return None
+        integrity = entry.get('integrity')
+        if integrity and integrity.split('-', 1)[0] == get_integrity_algorithm():
+            bundle.integrity = integrity
+        bundles[name] = bundle
+
     return bundles
 
 def rereference_bundles(bundles):
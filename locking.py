@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Exclusive lock held while building bundles, so only one of the processes
+# sharing a project builds them and the rest wait for it to finish. It's
+# also held by threads of the same process and can be acquired again by the
+# thread holding it. Without fcntl (i.e. on Windows) only threads are
+# serialized.
+
+import os
+from threading import RLock
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from django.conf import settings
+
+LOCK_NAME = '.bundles_lock'
+
+class FileLock(object):
+    def __init__(self, path):
+        self.path = path
+        self.fp = None
+        self.lock = RLock()
+        self.depth = 0
+
+    def acquire(self):
+        self.lock.acquire()
+        if self.depth == 0 and fcntl is not None:
+            try:
+                self.fp = open(self.path, 'a')
+                try:
+                    fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+                except:
+                    self.fp.close()
+                    self.fp = None
+                    raise
+            except:
+                self.lock.release()
+                raise
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        try:
+            # Only the outermost release unlocks the file
+            if self.depth == 0 and self.fp is not None:
+                fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+                self.fp.close()
+                self.fp = None
+        finally:
+            self.lock.release()
+
+def get_build_lock(base_dir):
+    path = getattr(settings, 'BUNDLES_LOCK_FILE', None)
+    if not path:
+        path = os.path.join(base_dir, LOCK_NAME)
+    return FileLock(path)
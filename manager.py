@@ -22,77 +22,438 @@
 
 import os
 import time
-from threading import Thread
+from threading import Thread, Lock, RLock
 
 from django.conf import settings
 
-from bundles.libbundler import get_bundles, BundleDoesNotExist
+from bundles.libbundler import get_bundles, load_manifest, load_bundles_conf, \
+    create_bundle, is_debug_mode, BundleDoesNotExist, MERGED_CONF_NAME
+from bundles.hashcache import get_hash_cache
+from bundles.builder import build_bundles, rebuild_bundles, process_bundle, \
+    get_jobs, ReferenceGraph
+from bundles.watcher import get_watcher
+from bundles.locking import get_build_lock
+from bundles.merging import MergeIndex
+from bundles import stats
+
+# A snapshot of the bundles. Once published by the manager it's never
+# modified, changes are made on a copy which then replaces it.
+class BundleRegistry(object):
+    def __init__(self, bundles, version=0):
+        self.bundles = bundles
+        self.version = version
+        self.merge_index = None
+
+    def get(self, bundle):
+        try:
+            return self.bundles[bundle]
+        except KeyError:
+            raise BundleDoesNotExist('Bundle %s not found' % bundle)
+
+    def get_merge_index(self):
+        if self.merge_index is None:
+            self.merge_index = MergeIndex(self.bundles)
+        return self.merge_index
+
+# Bundles from bundles.yaml which are only created, hashed and built when
+# they're first requested (directly or by a bundle referencing them)
+class LazyBundles(object):
+    def __init__(self, base_dir, raw_bundles, build_lock, on_load=None):
+        self.base_dir = base_dir
+        self.raw_bundles = raw_bundles
+        self.build_lock = build_lock
+        # Called with every bundle once it's loaded
+        self.on_load = on_load
+        self.loaded = {}
+        self.loading = {}
+        self.depth = 0
+
+    def __getitem__(self, name):
+        try:
+            return self.loaded[name]
+        except KeyError:
+            pass
+        if name not in self.raw_bundles:
+            raise KeyError(name)
+
+        # The build lock is reentrant and also serializes threads, so
+        # loading a bundle while the manager holds it doesn't deadlock
+        self.build_lock.acquire()
+        try:
+            if name in self.loaded:
+                return self.loaded[name]
+            # Reached again while building it, through a reference cycle
+            if name in self.loading:
+                return self.loading[name]
+            self.depth += 1
+            try:
+                bundle = self.loading[name] = create_bundle(name, self.raw_bundles[name])
+                self.link(bundle)
+                process_bundle(bundle, self, compress=True, rebuilt_only=True)
+                self.loaded[name] = bundle
+                del self.loading[name]
+                if self.on_load is not None:
+                    self.on_load(bundle)
+            finally:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.loading.clear()
+                    cache = get_hash_cache(self.base_dir)
+                    if cache is not None:
+                        try:
+                            cache.save()
+                        except (IOError, OSError):
+                            pass
+            return bundle
+        finally:
+            self.build_lock.release()
+
+    def link(self, bundle):
+        # Like link_bundles(), loading the referenced bundles first. Those
+        # still being loaded close a cycle and only count by their sources.
+        names = []
+        for ref in sorted(bundle.get_references(self)):
+            if ref == bundle.name or ref not in self:
+                continue
+            if ref in self.loading:
+                names.append(self.loading[ref].get_hash())
+            else:
+                names.append(self[ref].bundle_name)
+        bundle.set_reference_names(names)
+
+    def __setitem__(self, name, bundle):
+        self.loaded[name] = bundle
+
+    def copy(self):
+        # Only the bundles loaded so far are copied
+        bundles = LazyBundles(self.base_dir, self.raw_bundles, self.build_lock,
+            self.on_load)
+        bundles.loaded = dict(self.loaded)
+        return bundles
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return name in self.raw_bundles
+
+    def __iter__(self):
+        return iter(self.raw_bundles)
+
+    def __len__(self):
+        return len(self.raw_bundles)
+
+    def keys(self):
+        return self.raw_bundles.keys()
+
+    def iteritems(self):
+        for name in self.raw_bundles:
+            yield name, self[name]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return [bundle for name, bundle in self.iteritems()]
 
 class BundleManager(object):
+    _SHARED_MANAGER = None
+    _SHARED_LOCK = Lock()
+
     def __init__(self, base_dir):
+        # Nothing is done until the bundles are first needed
         self.base_dir = base_dir
-        self.build()
-        if settings.DEBUG:
-            BundleChecker(self).start()
+        self.graph = None
+        self.registry = None
+        self.checker = None
+        # Serializes writers, readers just grab the current registry
+        self.lock = Lock()
+        self.init_lock = Lock()
+        self.checker_lock = RLock()
+        # Serializes builds from other processes using the same bundles
+        self.build_lock = get_build_lock(base_dir)
+
+    def ensure_built(self):
+        if self.registry is None:
+            self.init_lock.acquire()
+            try:
+                if self.registry is None:
+                    self.build()
+                    if settings.DEBUG:
+                        self.start_checker()
+            finally:
+                self.init_lock.release()
+
+        return self.registry
+
+    def warm_up(self):
+        # Builds the bundles in the background
+        thread = Thread(target=self.ensure_built)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def start_checker(self):
+        # Building the bundles for the first time (in debug mode) starts
+        # the checker too, so it's done before looking for a running one
+        self.ensure_built()
+        self.checker_lock.acquire()
+        try:
+            if self.checker is None or not self.checker.isAlive():
+                # Lazy bundles can't be loaded between indexing the loaded
+                # ones and the checker being reachable from bundle_loaded()
+                self.build_lock.acquire()
+                try:
+                    self.checker = BundleChecker(self)
+                finally:
+                    self.build_lock.release()
+                self.checker.start()
+        finally:
+            self.checker_lock.release()
+
+    def acquire(self):
+        self.lock.acquire()
+        try:
+            self.build_lock.acquire()
+        except:
+            self.lock.release()
+            raise
+
+    def release(self):
+        self.build_lock.release()
+        self.lock.release()
+
+    @property
+    def bundles(self):
+        return self.ensure_built().bundles
+
+    def publish(self, bundles):
+        version = 0
+        if self.registry is not None:
+            version = self.registry.version + 1
+        self.registry = BundleRegistry(bundles, version)
 
     def build(self):
-        self.bundles = get_bundles(self.base_dir)
-        rebuilt = []
-        for bundle in self.bundles.values():
-            if bundle.build():
-                rebuilt.append(bundle)
-        for bundle in rebuilt:
-            bundle.rereference(self.bundles)
-            bundle.compress()
+        self.acquire()
+        try:
+            # Bundles built by "butil.py --build" come with a manifest which
+            # avoids parsing bundles.yaml and hashing every source file
+            if not is_debug_mode() and getattr(settings, 'BUNDLES_MANIFEST', True):
+                bundles = load_manifest(self.base_dir)
+                if bundles is not None:
+                    self.publish(bundles)
+                    return
 
+            if getattr(settings, 'BUNDLES_LAZY', False):
+                bundles = self.create_lazy()
+            else:
+                bundles = get_bundles(self.base_dir)
+                self.build_pending(bundles)
+            self.graph = None
+            self.publish(bundles)
+        finally:
+            self.release()
 
-    def get(self, bundle):
+    def create_lazy(self):
+        get_hash_cache(self.base_dir)
+        return LazyBundles(self.base_dir, load_bundles_conf(self.base_dir),
+            self.build_lock, self.bundle_loaded)
+
+    def bundle_loaded(self, bundle):
+        # Sources of lazy bundles are watched once they're loaded
+        checker = self.checker
+        if checker is not None:
+            checker.index_bundles([bundle])
+
+    def reload(self):
+        self.acquire()
         try:
-            return self.bundles[bundle]
-        except KeyError:
-            raise BundleDoesNotExist('Bundle %s not found' % bundle)
+            if isinstance(self.bundles, LazyBundles):
+                # Loaded again as they're requested
+                self.graph = None
+                self.publish(self.create_lazy())
+                return
+            # Bundles whose definition didn't change are kept as they are
+            bundles = get_bundles(self.base_dir, self.bundles)
+            self.build_pending(bundles)
+            self.graph = None
+            self.publish(bundles)
+        finally:
+            self.release()
+
+    def build_pending(self, bundles):
+        build_bundles(bundles, jobs=get_jobs(), compress=True,
+            rebuilt_only=True)
+
+    def get_graph(self):
+        bundles = self.bundles
+        if isinstance(bundles, LazyBundles):
+            # Bundles keep being loaded, so it's built every time from
+            # the ones loaded so far. Their references are cached.
+            return ReferenceGraph(bundles, bundles.loaded.keys())
+        if self.graph is None:
+            self.graph = ReferenceGraph(bundles)
+        return self.graph
+
+    def rebuild(self, names):
+        # Called when the sources of the named bundles change. The
+        # affected bundles are rebuilt as copies in a new registry.
+        self.acquire()
+        try:
+            bundles = self.bundles.copy()
+            rebuilt = rebuild_bundles(bundles, names, self.get_graph(),
+                compress=True)
+            self.publish(bundles)
+            return rebuilt
+        finally:
+            self.release()
+
+    def get(self, bundle):
+        registry = self.registry
+        if registry is None:
+            registry = self.ensure_built()
+        return registry.get(bundle)
 
     @classmethod
     def manager(cls):
+        if cls._SHARED_MANAGER is None:
+            cls._SHARED_LOCK.acquire()
+            try:
+                if cls._SHARED_MANAGER is None:
+                    cls._SHARED_MANAGER = cls(get_base_dir())
+            finally:
+                cls._SHARED_LOCK.release()
+
         return cls._SHARED_MANAGER
 
+# Hooks for servers which fork workers after loading the application, e.g.
+# for gunicorn:
+#
+#   def on_starting(server):
+#       from bundles.manager import preload
+#       preload()
+#
+#   def post_fork(server, worker):
+#       from bundles.manager import post_fork
+#       post_fork()
+#
+# so bundles are built once by the master and every worker inherits them.
+def preload():
+    manager = BundleManager.manager()
+    manager.ensure_built()
+    return manager
+
+def post_fork():
+    manager = BundleManager.manager()
+    # Threads don't survive fork()
+    if settings.DEBUG:
+        manager.start_checker()
+
 class BundleChecker(Thread):
+    # Changes arriving within this many seconds are handled together
+    debounce = 0.1
+
     def __init__(self, manager):
         super(BundleChecker, self).__init__()
-        self.mtimes = {}
+        self.setDaemon(True)
         self.manager = manager
-        self.full_names = {}
-        self.conf_path = os.path.join(manager.base_dir, 'bundles.yaml')
-        for bundle in self.manager.bundles.values():
-            for fname in bundle.files:
-                full_name = settings.MEDIA_ROOT + fname
-                self.full_names[full_name] = fname
-                self.mtimes[full_name] = os.stat(full_name).st_mtime
-        self.conf_mtime = os.stat(self.conf_path)
+        self.conf_paths = set([os.path.normpath(os.path.join(manager.base_dir, name)) \
+            for name in ('bundles.yaml', MERGED_CONF_NAME)])
+        self.update_index()
+        self.watcher = get_watcher(self.get_paths())
+
+    def update_index(self):
+        # Maps every source file to the names of the bundles using it. Lazy
+        # bundles are added by index_bundles() as they're loaded.
+        bundles = self.manager.bundles
+        if isinstance(bundles, LazyBundles):
+            bundles = bundles.loaded
+        index = {}
+        for bundle in bundles.values():
+            for source in bundle.hash_sources():
+                index.setdefault(os.path.normpath(source), set()).add(bundle.name)
+        self.index = index
+
+    def index_bundles(self, bundles):
+        # Replaces the sources of the given bundles, which might have been
+        # rebuilt with different ones (e.g. a new @import). The index is
+        # replaced, not modified, since it's read by run().
+        names = set([bundle.name for bundle in bundles])
+        index = {}
+        for path, users in self.index.iteritems():
+            users = users - names
+            if users:
+                index[path] = users
+        for bundle in bundles:
+            for source in bundle.hash_sources():
+                index.setdefault(os.path.normpath(source), set()).add(bundle.name)
+        self.index = index
+        self.watcher.set_paths(self.get_paths())
+
+    def get_paths(self):
+        return self.index.keys() + list(self.conf_paths)
+
+    def wait(self):
+        changed = self.watcher.wait()
+        if changed:
+            while True:
+                more = self.watcher.wait(self.debounce)
+                if not more:
+                    break
+                changed.update(more)
+
+        return changed
+
+    def get_change_time(self, paths):
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                pass
+        return mtimes and max(mtimes) or time.time()
 
     def run(self):
         while True:
-            for fname, value in self.mtimes.iteritems():
-                try:
-                    mtime = os.stat(fname).st_mtime
-                except OSError:
-                    continue
-                if value != mtime:
-                    self.mtimes[fname] = mtime
-                    for bundle in self.manager.bundles.values():
-                        if self.full_names[fname] in bundle.files:
-                            print 'Rebuilding bundle "%s"' % bundle.name
-                            bundle.rebuild()
+            changed = self.wait()
+            # A broken bundles.yaml or source file mustn't stop the checker,
+            # the current bundles are kept until the next change fixes it
             try:
-                mtime = os.stat(self.conf_path).st_mtime
-            except OSError:
-                continue
-            if mtime != self.conf_mtime:
-                print 'Reloading bundles'
-                self.conf_mtime = mtime
-                self.manager.build()
-            time.sleep(1)
+                self.check(changed)
+            except Exception, e:
+                print 'Error updating bundles: %s' % e
+
+    def check(self, changed):
+        changed_at = self.get_change_time(changed)
+        if changed & self.conf_paths:
+            changed -= self.conf_paths
+            print 'Reloading bundles'
+            self.manager.reload()
+            self.update_index()
+            self.watcher.set_paths(self.get_paths())
+
+        names = set()
+        for path in changed:
+            names.update(self.index.get(path, ()))
+        if names:
+            rebuilt = self.manager.rebuild(names)
+            bundles = self.manager.bundles
+            self.index_bundles([bundles[name] for name in rebuilt])
+            # Time from the file being saved to the bundles being published
+            latency = max(time.time() - changed_at, 0)
+            for name in rebuilt:
+                stats.record(name, 'watch', latency)
+                print 'Rebuilt bundle "%s" (%.0fms after the change)' % \
+                    (name, latency * 1000)
 
 # Move to top project dir
 proj_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-BundleManager._SHARED_MANAGER = BundleManager(proj_dir)
+
+def get_base_dir():
+    return getattr(settings, 'BUNDLES_DIR', proj_dir)
+
+if getattr(settings, 'BUNDLES_WARMUP', False):
+    BundleManager.manager().warm_up()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Bundles which are almost always requested together are merged into one,
+# saving requests. analyze() finds them in the usage recorded by
+# bundles.usage and write_merged_conf() saves them to bundles.merged.yaml,
+# where every merged bundle just lists its members:
+#
+#   merged/0123456789.js:
+#       merge:
+#           - base.js
+#           - widgets.js
+#
+# Only bundles of the same type and options (e.g. the same CSS media) are
+# merged. The {% bundles %} tag includes the merged bundle instead of its
+# members when all of them are requested in a row. See MergeIndex.
+
+import os
+from hashlib import sha1
+
+import yaml
+
+from bundles.libbundler import get_merge_group, MERGED_CONF_NAME
+
+# Longest run of bundles considered for a merged bundle
+MAX_MERGED = 10
+
+def iter_options(bundles):
+    # Yields (name, options) without creating lazily loaded bundles
+    raw_bundles = getattr(bundles, 'raw_bundles', None)
+    if raw_bundles is not None:
+        for name, dct in raw_bundles.iteritems():
+            yield name, dct or {}
+    else:
+        for name, bundle in bundles.iteritems():
+            yield name, bundle.options
+
+def get_runs(call, groups):
+    # Splits the names requested by a tag into the runs of consecutive
+    # bundles in the same group, skipping those of other file types
+    by_type = {}
+    for name in call:
+        group = groups.get(name)
+        if group is not None:
+            by_type.setdefault(group[0], []).append(name)
+
+    runs = []
+    for names in by_type.values():
+        run = [names[0]]
+        for name in names[1:]:
+            if groups[name] == groups[run[-1]] and name not in run:
+                run.append(name)
+            else:
+                runs.append(run)
+                run = [name]
+        runs.append(run)
+    return [run for run in runs if len(run) > 1]
+
+def analyze(pages, raw_bundles, min_share=0.9, min_count=10):
+    # Returns [(members, count)] for the runs of bundles requested
+    # together by at least min_count pages and by at least min_share of
+    # the pages using any of its members
+    groups = {}
+    for name, dct in raw_bundles.iteritems():
+        if not (dct or {}).get('merge'):
+            groups[name] = get_merge_group(name, dct)
+    groups = dict((name, group) for name, group in groups.iteritems() if group is not None)
+
+    usage = {}
+    counts = {}
+    for page, count in pages.iteritems():
+        used = set()
+        candidates = set()
+        for call in page:
+            used.update(call)
+            for run in get_runs(call, groups):
+                for start in range(len(run) - 1):
+                    for end in range(start + 2, min(len(run), start + MAX_MERGED) + 1):
+                        candidates.add(tuple(run[start:end]))
+        for name in used:
+            usage[name] = usage.get(name, 0) + count
+        for members in candidates:
+            counts[members] = counts.get(members, 0) + count
+
+    accepted = []
+    for members, count in counts.iteritems():
+        if count >= min_count and \
+            all([count >= min_share * usage[name] for name in members]):
+            accepted.append((members, count))
+
+    # Longest (and most used) first, every bundle is merged only once
+    accepted.sort(key=lambda item: (-len(item[0]), -item[1], item[0]))
+    proposals = []
+    merged = set()
+    for members, count in accepted:
+        if not merged.intersection(members):
+            proposals.append((list(members), count))
+            merged.update(members)
+    return proposals
+
+def get_merged_name(members, raw_bundles):
+    file_type = get_merge_group(members[0], raw_bundles[members[0]])[0]
+    return 'merged/%s.%s' % (sha1('\n'.join(members)).hexdigest()[:10], file_type)
+
+def write_merged_conf(base_dir, proposals, raw_bundles):
+    merged = {}
+    for members, count in proposals:
+        merged[get_merged_name(members, raw_bundles)] = {'merge': members}
+    fp = open(os.path.join(base_dir, MERGED_CONF_NAME), 'w')
+    try:
+        fp.write('# Generated by butil.py --merge-usage, edits will be lost\n')
+        if merged:
+            fp.write(yaml.safe_dump(merged, default_flow_style=False))
+    finally:
+        fp.close()
+    return merged
+
+class MergeIndex(object):
+    def __init__(self, bundles):
+        self.groups = {}
+        # Maps the first member of every merged bundle to its name
+        # and members
+        self.first = {}
+        for name, dct in iter_options(bundles):
+            self.groups[name] = get_merge_group(name, dct)
+            members = dct.get('merge')
+            if members:
+                current = self.first.get(members[0])
+                if current is None or len(current[1]) < len(members):
+                    self.first[members[0]] = (name, tuple(members))
+
+    def match(self, names, start, members):
+        # Returns the positions of members in names if they're requested
+        # in the same order, with no other bundle of the same type between
+        # them, or None
+        file_type = self.groups[members[0]][0]
+        found = []
+        for ii in range(start, len(names)):
+            group = self.groups.get(names[ii])
+            if group is None or group[0] != file_type:
+                continue
+            if names[ii] != members[len(found)]:
+                return None
+            found.append(ii)
+            if len(found) == len(members):
+                return found
+        return None
+
+    def substitute(self, names):
+        # Returns names with the merged bundles replacing their members
+        if not self.first:
+            return names
+        result = []
+        replaced = set()
+        for ii, name in enumerate(names):
+            if ii in replaced:
+                continue
+            entry = self.first.get(name)
+            if entry is not None:
+                found = self.match(names, ii, entry[1])
+                if found is not None:
+                    replaced.update(found)
+                    result.append(entry[0])
+                    continue
+            result.append(name)
+        return result
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# PreloadMiddleware adds a "Link: <url>; rel=preload" header to HTML
+# responses for every bundle included by the templates rendered for them,
+# so browsers can start fetching the bundles before parsing the page.
+#
+# The last Link header sent for every path is also kept, for servers able
+# to send it in a 103 Early Hints response before the view runs. See
+# get_early_hints(). At most settings.BUNDLES_EARLY_HINTS_SIZE paths are
+# remembered (1000 by default, 0 disables it).
+#
+# UsageMiddleware records which bundles are requested together by the
+# templates of a sample of the pages. See bundles.usage.
+
+import random
+from threading import local, Lock
+
+from django.conf import settings
+
+from bundles.libbundler import BUNDLES_URL, is_debug_mode
+from bundles.usage import get_usage_recorder
+
+_LOCAL = local()
+
+class Recording(object):
+    def __init__(self, request):
+        self.request = request
+        self.depth = 0
+        # Rendered bundles, in order
+        self.bundles = []
+        self.names = set()
+        # Names passed to every tag
+        self.calls = []
+
+def record_bundles(bundles, requested):
+    # Called by the template tags with the bundles they rendered and the
+    # names they were given, does nothing outside a request
+    recording = getattr(_LOCAL, 'recording', None)
+    if recording is None:
+        return
+    for bundle in bundles:
+        if bundle.name not in recording.names:
+            recording.bundles.append(bundle)
+            recording.names.add(bundle.name)
+    recording.calls.append(tuple(requested))
+
+def start_recording(request):
+    # Every middleware using the recording starts it and stops it
+    recording = getattr(_LOCAL, 'recording', None)
+    if recording is None or recording.request is not request:
+        recording = _LOCAL.recording = Recording(request)
+    recording.depth += 1
+
+def stop_recording(request):
+    # Returns the Recording for request
+    recording = getattr(_LOCAL, 'recording', None)
+    if recording is None or recording.request is not request:
+        return Recording(request)
+    recording.depth -= 1
+    if recording.depth == 0:
+        _LOCAL.recording = None
+    return recording
+
+def get_link(bundle):
+    link = '<%s%s>; rel=preload; as=%s' % (BUNDLES_URL, bundle.bundle_name,
+        bundle.preload_as)
+    if bundle.supports_integrity and bundle.get_integrity():
+        # Must match the tag, or the preloaded response isn't used
+        link += '; crossorigin=anonymous'
+    return link
+
+_EARLY_HINTS = {}
+_EARLY_HINTS_LOCK = Lock()
+
+def get_early_hints(path):
+    # Returns the Link header last sent for path, or None
+    return _EARLY_HINTS.get(path)
+
+def set_early_hints(path, links):
+    size = getattr(settings, 'BUNDLES_EARLY_HINTS_SIZE', 1000)
+    if not size:
+        return
+    _EARLY_HINTS_LOCK.acquire()
+    try:
+        if path not in _EARLY_HINTS and len(_EARLY_HINTS) >= size:
+            _EARLY_HINTS.clear()
+        _EARLY_HINTS[path] = links
+    finally:
+        _EARLY_HINTS_LOCK.release()
+
+class PreloadMiddleware(object):
+    def process_request(self, request):
+        # In debug mode the templates include the source files
+        if not is_debug_mode():
+            request.bundles_preload = True
+            start_recording(request)
+
+    def process_response(self, request, response):
+        if not getattr(request, 'bundles_preload', False):
+            return response
+        # Preloads without "as" aren't matched with the request for the
+        # bundle, which is then fetched twice
+        used = [bundle for bundle in stop_recording(request).bundles if bundle.preload_as]
+        if not used or response.status_code != 200 or \
+            not response.get('Content-Type', '').startswith('text/html'):
+            return response
+
+        links = ', '.join([get_link(bundle) for bundle in used])
+        set_early_hints(request.path, links)
+        if response.has_header('Link'):
+            links = '%s, %s' % (response['Link'], links)
+        response['Link'] = links
+        return response
+
+class UsageMiddleware(object):
+    def process_request(self, request):
+        recorder = get_usage_recorder()
+        if recorder is not None and random.random() < recorder.sample:
+            request.bundles_usage = True
+            start_recording(request)
+
+    def process_response(self, request, response):
+        if not getattr(request, 'bundles_usage', False):
+            return response
+        calls = stop_recording(request).calls
+        if calls and response.status_code == 200:
+            get_usage_recorder().add(calls)
+        return response
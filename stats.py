@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Build instrumentation. Every phase of a bundle build is recorded as
+# (bundle name, phase, seconds, bytes in, bytes out) and sent through the
+# phase_finished signal. Records are also kept by every BuildStats started
+# with collect(), until it's passed to stop().
+#
+# The phases are "hash", "build" (concatenation), "inline" (images inlined
+# in CSS bundles), "rereference", "compress", "gzip" and "watch" (from a
+# source file being saved to its bundle being published again by
+# BundleChecker).
+
+import time
+from threading import Lock
+
+from django.dispatch import Signal
+
+phase_finished = Signal(providing_args=['bundle', 'phase', 'seconds',
+    'bytes_in', 'bytes_out'])
+
+PHASES = ('hash', 'build', 'inline', 'rereference', 'compress', 'gzip', 'watch')
+
+class BuildStats(object):
+    def __init__(self):
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+
+    def get_totals(self):
+        # {bundle: {phase: [seconds, bytes in, bytes out, count]}}
+        totals = {}
+        for bundle, phase, seconds, bytes_in, bytes_out in self.records:
+            total = totals.setdefault(bundle, {}).setdefault(phase, [0.0, 0, 0, 0])
+            total[0] += seconds
+            total[1] += bytes_in
+            total[2] += bytes_out
+            total[3] += 1
+        return totals
+
+    def get_phase_totals(self):
+        phases = {}
+        for bundle, totals in self.get_totals().iteritems():
+            for phase, total in totals.iteritems():
+                phase_total = phases.setdefault(phase, [0.0, 0, 0, 0])
+                for ii in range(4):
+                    phase_total[ii] += total[ii]
+        return phases
+
+    def report(self):
+        def as_dict(total):
+            return {
+                'seconds': total[0],
+                'bytes_in': total[1],
+                'bytes_out': total[2],
+                'count': total[3],
+            }
+
+        bundles = {}
+        for bundle, totals in self.get_totals().iteritems():
+            bundles[bundle] = dict((phase, as_dict(total)) for phase, total in totals.iteritems())
+        phases = dict((phase, as_dict(total)) for phase, total in \
+            self.get_phase_totals().iteritems())
+        return {'bundles': bundles, 'phases': phases}
+
+    def table(self):
+        phases = [phase for phase in PHASES if phase in self.get_phase_totals()]
+        lines = ['%-40s' % 'Bundle' + ''.join(['%14s' % phase for phase in phases])]
+        rows = sorted(self.get_totals().items())
+        rows.append(('TOTAL', self.get_phase_totals()))
+        for bundle, totals in rows:
+            times = []
+            sizes = []
+            for phase in phases:
+                total = totals.get(phase)
+                if total is None:
+                    times.append('%14s' % '-')
+                    sizes.append('%14s' % '')
+                else:
+                    times.append('%12.1fms' % (total[0] * 1000))
+                    sizes.append('%14s' % format_size(max(total[1], total[2])))
+            lines.append('%-40s' % bundle[:40] + ''.join(times))
+            lines.append('%-40s' % '' + ''.join(sizes))
+        return '\n'.join(lines)
+
+def format_size(size):
+    if size >= 1024 * 1024:
+        return '%.1fMB' % (size / 1024.0 / 1024.0)
+    if size >= 1024:
+        return '%.1fKB' % (size / 1024.0)
+    return '%dB' % size
+
+_COLLECTORS = []
+_LOCK = Lock()
+_SEND_SIGNALS = True
+
+def collect():
+    stats = BuildStats()
+    _LOCK.acquire()
+    try:
+        _COLLECTORS.append(stats)
+    finally:
+        _LOCK.release()
+    return stats
+
+def stop(stats):
+    _LOCK.acquire()
+    try:
+        _COLLECTORS.remove(stats)
+    finally:
+        _LOCK.release()
+
+def set_signals(enabled):
+    # Build worker processes just return their records to the parent,
+    # which sends the signals
+    global _SEND_SIGNALS
+    _SEND_SIGNALS = enabled
+
+def record(bundle, phase, seconds, bytes_in=0, bytes_out=0):
+    item = (bundle, phase, seconds, bytes_in, bytes_out)
+    _LOCK.acquire()
+    try:
+        for stats in _COLLECTORS:
+            stats.add(item)
+    finally:
+        _LOCK.release()
+    if _SEND_SIGNALS:
+        phase_finished.send(sender=None, bundle=bundle, phase=phase,
+            seconds=seconds, bytes_in=bytes_in, bytes_out=bytes_out)
+
+def replay(records):
+    for item in records:
+        record(*item)
+
+class Timer(object):
+    def __init__(self, bundle, phase):
+        self.bundle = bundle
+        self.phase = phase
+        self.start = time.time()
+
+    def stop(self, bytes_in=0, bytes_out=0):
+        record(self.bundle, self.phase, time.time() - self.start, bytes_in, bytes_out)
@@ -24,6 +24,7 @@ from django import template
 
 from bundles.libbundler import BUNDLES_URL
 from bundles.manager import BundleManager
+from bundles.middleware import record_bundles
 
 register = template.Library()
 
@@ -31,7 +32,9 @@ MANAGER = BundleManager.manager()
 
 @register.simple_tag
 def bundle(value):
-    return MANAGER.get(value).include()
+    bndl = MANAGER.get(value)
+    record_bundles([bndl], [value])
+    return bndl.include()
 
 @register.simple_tag
 def bundle_url_path(value):
@@ -49,15 +52,49 @@ def external_bundle(value):
 def bundles(parser, token):
     return BundleNode(*token.split_contents()[1:])
 
+def is_string_literal(arg):
+    return len(arg) > 1 and arg[0] == arg[-1] and arg[0] in ('"', "'")
+
 class BundleNode(template.Node):
     def __init__(self, *args):
         self.bundles = []
+        # When every argument is a string literal the markup only changes
+        # with the bundles, so it's cached for each registry version
+        self.literal = True
+        self.cache = None
         for arg in args:
-            self.bundles.append(template.Variable(arg))
+            if is_string_literal(arg):
+                self.bundles.append(arg[1:-1])
+            else:
+                self.literal = False
+                self.bundles.append(template.Variable(arg))
+
+    def get_used(self, registry, names):
+        # Merged bundles replace their members, see bundles.merging
+        names = registry.get_merge_index().substitute(names)
+        return [registry.get(bndl) for bndl in names]
+
+    def render_literal(self):
+        registry = MANAGER.ensure_built()
+        cache = self.cache
+        if cache is None or cache[0] != registry.version:
+            used = self.get_used(registry, self.bundles)
+            markup = u''.join([bndl.include() for bndl in used])
+            cache = self.cache = (registry.version, markup, used)
+
+        record_bundles(cache[2], self.bundles)
+        return cache[1]
 
     def render(self, context):
-        markup = []
+        if self.literal:
+            return self.render_literal()
+
+        names = []
         for bndl in self.bundles:
-            markup.append(bundle(bndl.resolve(context)))
+            if isinstance(bndl, template.Variable):
+                bndl = bndl.resolve(context)
+            names.append(bndl)
 
-        return u''.join(markup)
+        used = self.get_used(MANAGER.ensure_built(), names)
+        record_bundles(used, names)
+        return u''.join([bndl.include() for bndl in used])
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Records which bundles are requested together by the pages, so butil.py
+# can propose merging the bundles which are almost always used together.
+# UsageMiddleware samples settings.BUNDLES_USAGE_SAMPLE of the requests
+# (0.1 by default) and passes the names given to every template tag for
+# each page to the recorder, which counts them in memory and appends them
+# as JSON lines to settings.BUNDLES_USAGE_FILE every BUNDLES_USAGE_FLUSH
+# pages (100 by default) and at exit. Nothing is recorded unless
+# BUNDLES_USAGE_FILE is set. Every process appends to the same file, so the
+# counts are added by load_usage().
+
+import os
+import atexit
+from threading import Lock
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from django.conf import settings
+
+class UsageRecorder(object):
+    def __init__(self, path, sample=0.1, flush_every=100):
+        self.path = path
+        self.sample = sample
+        self.flush_every = flush_every
+        # {((name, ...), ...): count}, one tuple of names per tag
+        self.pages = {}
+        self.pending = 0
+        self.lock = Lock()
+
+    def add(self, calls):
+        page = tuple([tuple(call) for call in calls])
+        self.lock.acquire()
+        try:
+            self.pages[page] = self.pages.get(page, 0) + 1
+            self.pending += 1
+            flush = self.pending >= self.flush_every
+        finally:
+            self.lock.release()
+        if flush:
+            self.flush()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            pages = self.pages
+            self.pages = {}
+            self.pending = 0
+        finally:
+            self.lock.release()
+        if not pages:
+            return
+
+        data = ''.join([json.dumps({'calls': page, 'count': count}) + '\n' \
+            for page, count in pages.iteritems()])
+        try:
+            # A single write in append mode, so lines from several
+            # processes don't get mixed
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        except (IOError, OSError), e:
+            print 'Could not write bundle usage to %s: %s' % (self.path, e)
+
+def load_usage(path):
+    # Returns {((name, ...), ...): count} with the pages recorded in path
+    pages = {}
+    fp = open(path)
+    try:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Truncated by a process killed while writing
+                continue
+            page = tuple([tuple(call) for call in entry['calls']])
+            pages[page] = pages.get(page, 0) + entry['count']
+    finally:
+        fp.close()
+    return pages
+
+_RECORDER = None
+_RECORDER_LOCK = Lock()
+
+def get_usage_recorder():
+    global _RECORDER
+    if _RECORDER is None:
+        path = getattr(settings, 'BUNDLES_USAGE_FILE', None)
+        if not path:
+            return None
+        _RECORDER_LOCK.acquire()
+        try:
+            if _RECORDER is None:
+                recorder = UsageRecorder(path,
+                    getattr(settings, 'BUNDLES_USAGE_SAMPLE', 0.1),
+                    getattr(settings, 'BUNDLES_USAGE_FLUSH', 100))
+                atexit.register(recorder.flush)
+                _RECORDER = recorder
+        finally:
+            _RECORDER_LOCK.release()
+
+    return _RECORDER
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Serves the bundles from memory, for deployments without a static files
+# server in front of Django. Include bundles.urls at BUNDLES_URL:
+#
+#   (r'^media/bundles/', include('bundles.urls')),
+#
+# Bundle names change with their contents, so responses can be cached
+# forever. The ETag is a digest of the bytes sent. The .gz sidecar is sent
+# to clients accepting gzip. Up to settings.BUNDLES_SERVE_CACHE_SIZE bytes
+# (16MB by default) are kept in memory, evicting the least recently
+# served bundles first. Cached files are read again when they change on
+# disk, e.g. when rebuilt in debug mode.
+#
+# With settings.BUNDLES_DEBUG_CONCATENATE, debug mode includes every
+# bundle as a single file concatenated on every request by serve_debug(),
+# instead of every source file on its own. It's requested by its name
+# with a "debug" query string, e.g. css/site.css?debug.
+
+import os
+import hashlib
+import mimetypes
+from itertools import imap
+from threading import Lock
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.http import require_http_methods
+
+from bundles.libbundler import BundleDoesNotExist, split_lines
+from bundles.manager import BundleManager
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+DEFAULT_CACHE_SIZE = 16 * 1024 * 1024
+
+class ContentCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.tick = 0
+        # {key: [value, last served tick, size]}
+        self.entries = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.tick += 1
+            entry[1] = self.tick
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, size):
+        # Bundles taking a big share of the cache are always read from disk
+        if size > self.max_size / 4:
+            return
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                return
+            self.tick += 1
+            self.entries[key] = [value, self.tick, size]
+            self.size += size
+            if self.size > self.max_size:
+                # Evicted in bulk, so sorting doesn't happen on every set
+                entries = sorted(self.entries.items(), key=lambda item: item[1][1])
+                for old_key, (old_value, tick, old_size) in entries:
+                    if self.size <= self.max_size * 3 / 4:
+                        break
+                    del self.entries[old_key]
+                    self.size -= old_size
+        finally:
+            self.lock.release()
+
+_CACHE = None
+
+def get_cache():
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = ContentCache(getattr(settings, 'BUNDLES_SERVE_CACHE_SIZE',
+            DEFAULT_CACHE_SIZE))
+    return _CACHE
+
+def accepts_gzip(request):
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = [part.strip() for part in coding.split(';')]
+        if parts[0].lower() in ('gzip', '*'):
+            for param in parts[1:]:
+                if param.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                    return False
+            return True
+    return False
+
+def is_not_modified(request, etag):
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag.strip('"') in parse_etags(header)
+
+def read_file(path):
+    fp = open(path, 'rb')
+    try:
+        return fp.read()
+    finally:
+        fp.close()
+
+def get_content_type(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+def get_bundle(path):
+    # Bundle names are "<name>.<hash>.<extension>" or "<name>.<hash>"
+    parts = path.rsplit('.', 2)
+    names = [path.rsplit('.', 1)[0]]
+    if len(parts) == 3:
+        names.insert(0, '%s.%s' % (parts[0], parts[2]))
+    manager = BundleManager.manager()
+    for name in names:
+        try:
+            bundle = manager.get(name)
+        except BundleDoesNotExist:
+            continue
+        # Only the current version of every bundle is available
+        if bundle.bundle_name == path:
+            return bundle
+    raise Http404('Bundle %s not found' % path)
+
+def make_response(request, data, content_type, headers):
+    response = HttpResponse(content_type=content_type)
+    for header, value in headers:
+        response[header] = value
+    response['Content-Length'] = str(len(data))
+    if request.method != 'HEAD':
+        response.content = data
+    return response
+
+def read_cached(path):
+    # Returns the contents of the file at path and their ETag. Cached
+    # entries are keyed by the file signature, so they're never stale.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    cache = get_cache()
+    key = (path, st.st_ino, st.st_mtime, st.st_size)
+    entry = cache.get(key)
+    if entry is None:
+        try:
+            data = read_file(path)
+        except IOError:
+            return None
+        entry = (data, quote_etag(hashlib.sha1(data).hexdigest()))
+        cache.set(key, entry, len(data))
+    return entry
+
+@require_http_methods(['GET', 'HEAD'])
+def serve(request, path):
+    if 'debug' in request.GET:
+        return serve_debug(request, path)
+    bundle = get_bundle(path)
+    headers = [('Cache-Control', CACHE_CONTROL)]
+    gzip_path = None
+    if bundle.gzip:
+        headers.append(('Vary', 'Accept-Encoding'))
+        if accepts_gzip(request) and os.path.exists(bundle.get_gzip_path()):
+            gzip_path = bundle.get_gzip_path()
+            headers.append(('Content-Encoding', 'gzip'))
+
+    # Every encoding is a different representation, with its own ETag
+    entry = read_cached(gzip_path or bundle.get_bundle_path())
+    if entry is None:
+        raise Http404('Bundle %s not found' % path)
+    data, etag = entry
+    headers.append(('ETag', etag))
+
+    if is_not_modified(request, etag):
+        response = HttpResponseNotModified()
+        for header, value in headers:
+            if header != 'Content-Encoding':
+                response[header] = value
+        return response
+
+    return make_response(request, data, get_content_type(bundle.name), headers)
+
+@require_http_methods(['GET', 'HEAD'])
+def serve_debug(request, name):
+    manager = BundleManager.manager()
+    try:
+        bundle = manager.get(name)
+    except BundleDoesNotExist:
+        raise Http404('Bundle %s not found' % name)
+
+    # Built like the bundle itself, with the references to other bundles
+    # rewritten, on a copy so the bundle being served isn't modified
+    bundle = bundle.clone()
+    chunks = bundle.read_sources()
+    rewrite = bundle.get_rewriter(manager.bundles)
+    if rewrite:
+        chunks = imap(rewrite, split_lines(chunks))
+    try:
+        data = ''.join(chunks)
+    except IOError:
+        raise Http404('Bundle %s not found' % name)
+
+    etag = quote_etag(hashlib.sha1(data).hexdigest())
+    headers = [('Cache-Control', 'no-cache'), ('ETag', etag)]
+    if is_not_modified(request, etag):
+        response = HttpResponseNotModified()
+        for header, value in headers:
+            response[header] = value
+        return response
+
+    return make_response(request, data, get_content_type(bundle.name), headers)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# File watchers used by BundleChecker. Both have the same interface:
+# set_paths() replaces the set of watched files and wait() blocks until
+# some of them change (or the timeout expires), returning the changed paths.
+# Paths must be normalized with os.path.normpath().
+
+import os
+import sys
+import time
+import select
+import struct
+
+from django.conf import settings
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+# Editors often save by writing a new file and renaming it over the old
+# one, so the directories are watched instead of the files
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+    IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = 'iIII'
+EVENT_HEADER_SIZE = struct.calcsize(EVENT_HEADER)
+
+class PollingWatcher(object):
+    def __init__(self, paths, interval=1):
+        self.interval = interval
+        self.mtimes = {}
+        self.set_paths(paths)
+
+    def get_mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def set_paths(self, paths):
+        mtimes = {}
+        for path in paths:
+            if path in self.mtimes:
+                mtimes[path] = self.mtimes[path]
+            else:
+                mtimes[path] = self.get_mtime(path)
+        self.mtimes = mtimes
+
+    def wait(self, timeout=None):
+        if timeout is None:
+            timeout = self.interval
+        time.sleep(timeout)
+        changed = set()
+        for path, value in self.mtimes.iteritems():
+            mtime = self.get_mtime(path)
+            if mtime != value:
+                self.mtimes[path] = mtime
+                changed.add(path)
+
+        return changed
+
+    def close(self):
+        pass
+
+class InotifyWatcher(object):
+    def __init__(self, paths):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init() failed')
+        self.dirs = {}
+        self.watches = {}
+        self.set_paths(paths)
+
+    def set_paths(self, paths):
+        self.paths = set(paths)
+        for path in self.paths:
+            directory = os.path.dirname(path)
+            if directory in self.watches:
+                continue
+            native = directory
+            if isinstance(native, unicode):
+                native = native.encode(sys.getfilesystemencoding())
+            wd = self.libc.inotify_add_watch(self.fd, native, WATCH_MASK)
+            if wd >= 0:
+                self.watches[directory] = wd
+                self.dirs[wd] = directory
+
+    def wait(self, timeout=None):
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return set()
+
+        changed = set()
+        data = os.read(self.fd, 64 * 1024)
+        pos = 0
+        while pos + EVENT_HEADER_SIZE <= len(data):
+            wd, mask, cookie, length = struct.unpack_from(EVENT_HEADER, data, pos)
+            pos += EVENT_HEADER_SIZE
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, assume everything changed
+                return set(self.paths)
+            if wd in self.dirs:
+                path = os.path.join(self.dirs[wd], name)
+                if path in self.paths:
+                    changed.add(path)
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+def get_watcher(paths):
+    if getattr(settings, 'BUNDLES_WATCHER', 'inotify') == 'inotify':
+        try:
+            return InotifyWatcher(paths)
+        except (ImportError, AttributeError, OSError):
+            pass
+
+    return PollingWatcher(paths)
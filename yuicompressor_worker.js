@@ -0,0 +1,90 @@
+// Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+// Released under the same license as the rest of this application,
+// see COPYING.
+
+// Resident YUI Compressor for compressors.py, so the JVM is started once
+// instead of once for every bundle. Run it with Rhino and YUI Compressor
+// in the classpath (YUI Compressor first, it ships patched Rhino classes):
+//
+//   java -cp yuicompressor.jar:js.jar \
+//       org.mozilla.javascript.tools.shell.Main yuicompressor_worker.js
+//
+// and it serves requests from stdin until it's closed:
+//
+//   request:  "<file type> <length>\n<data>"
+//   response: "OK <length>\n<compressed data>" or "ERR <length>\n<message>"
+//
+// Lengths are in bytes and data is UTF-8.
+
+/*global java, org, com, JavaAdapter */
+
+(function () {
+    var input = new java.io.DataInputStream(new java.io.BufferedInputStream(java.lang.System['in'])),
+        output = new java.io.BufferedOutputStream(java.lang.System.out),
+        compressor = com.yahoo.platform.yui.compressor;
+
+    function readHeader() {
+        var line = new java.lang.StringBuilder(), ch;
+        while (true) {
+            ch = input.read();
+            if (ch < 0) {
+                return null;
+            }
+            if (ch === 10) {
+                return String(line.toString());
+            }
+            line.append(String.fromCharCode(ch));
+        }
+    }
+
+    function write(status, payload) {
+        var bytes = new java.lang.String(payload).getBytes('UTF-8');
+        output.write(new java.lang.String(status + ' ' + bytes.length + '\n').getBytes('UTF-8'));
+        output.write(bytes);
+        output.flush();
+    }
+
+    function compress(fileType, source) {
+        var reader = new java.io.StringReader(source),
+            writer = new java.io.StringWriter(),
+            errors = [],
+            reporter;
+
+        if (fileType === 'css') {
+            new compressor.CssCompressor(reader).compress(writer, -1);
+        } else {
+            reporter = new JavaAdapter(org.mozilla.javascript.ErrorReporter, {
+                warning: function () {},
+                error: function (message, sourceName, line) {
+                    errors.push('[ERROR] ' + line + ': ' + message);
+                },
+                runtimeError: function (message, sourceName, line) {
+                    errors.push('[ERROR] ' + line + ': ' + message);
+                    return new org.mozilla.javascript.EvaluatorException(message);
+                }
+            });
+            try {
+                // Same defaults as the command line: munge, no line breaks
+                new compressor.JavaScriptCompressor(reader, reporter).compress(writer,
+                    -1, true, false, false, false);
+            } catch (e) {
+                throw new Error(errors.length ? errors.join('\n') : String(e));
+            }
+        }
+        return String(writer.toString());
+    }
+
+    var header, parts, data, result;
+    while ((header = readHeader()) !== null) {
+        parts = header.split(' ');
+        data = java.lang.reflect.Array.newInstance(java.lang.Byte.TYPE, parseInt(parts[1], 10));
+        input.readFully(data);
+        try {
+            result = compress(parts[0], String(new java.lang.String(data, 'UTF-8')));
+        } catch (e) {
+            write('ERR', String(e.message || e));
+            continue;
+        }
+        write('OK', result);
+    }
+}());